@@ -0,0 +1,88 @@
+"""
+Helper para cache em memória e hash de conteúdo
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Tentar importar o blake3 (hash acelerado por SIMD)
+try:
+    import blake3
+    blake3_available = True
+except ImportError:
+    blake3_available = False
+    logger.info("blake3 não encontrado. Usando hashlib.blake2b para o hash de conteúdo.")
+
+def content_hash(data):
+    """
+    Calcula o hash hexadecimal de um conteúdo para uso como chave de cache.
+    Usa BLAKE3 quando disponível e BLAKE2b como alternativa.
+
+    Args:
+        data (bytes | str): Conteúdo a ser processado
+
+    Returns:
+        str: Hash hexadecimal do conteúdo
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if blake3_available:
+        return blake3.blake3(data).hexdigest()
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+class LRUCache:
+    """
+    Cache LRU em memória, seguro para uso entre threads,
+    com tempo de expiração opcional para as entradas.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        """
+        Args:
+            maxsize (int): Número máximo de entradas mantidas
+            ttl (float, optional): Tempo de vida das entradas em segundos
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Retorna o valor associado à chave ou `default` se ausente/expirado."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Armazena o valor, descartando a entrada menos usada se o cache estiver cheio."""
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a entrada e retorna seu valor."""
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        """Remove todas as entradas."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
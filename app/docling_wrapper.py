@@ -5,20 +5,101 @@ para processá-los ao invés de converter para markdown.
 import io
 import os
 import logging
-import tempfile
 import base64
 from typing import Optional
 import json
 from PIL import Image
-import pdf2image  # Precisamos instalar: pip install pdf2image
+import fitz  # PyMuPDF
 from openai import OpenAI
 import re
-import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from app.cache_helper import LRUCache, content_hash
 
 logger = logging.getLogger(__name__)
 
+# Tentar importar o pybase64 (codificação base64 acelerada por SIMD)
+try:
+    import pybase64
+    pybase64_available = True
+except ImportError:
+    pybase64_available = False
+    logger.info("pybase64 não encontrado. Usando o módulo base64 padrão.")
+
+# Número máximo de páginas enviadas simultaneamente para a API Vision
+VISION_PARALLELISM = int(os.getenv("VISION_PARALLELISM", "8"))
+
+# Qualidade JPEG usada nas páginas renderizadas (suficiente para leitura pela API Vision)
+PAGE_JPEG_QUALITY = 80
+
+# Tipos MIME das imagens enviadas diretamente, por extensão
+IMAGE_MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+}
+
+# Prompt de sistema usado na extração de cada página
+VISION_SYSTEM_PROMPT = (
+    "Você é um assistente especializado em extrair e formatar informações de documentos financeiros e empresariais. "
+    "Formate o conteúdo de maneira organizada e estruturada, similar a markdown, preservando todos os dados "
+    "e tabelas importantes. Mantenha a estrutura hierárquica do documento."
+)
+
+# Versão do prompt: alterar o prompt invalida automaticamente os resultados em cache
+VISION_PROMPT_VERSION = content_hash(VISION_SYSTEM_PROMPT)[:16]
+
+# Cache dos resultados da Vision por (hash do conteúdo, modelo, versão do prompt)
+_vision_cache = LRUCache(maxsize=int(os.getenv("VISION_CACHE_SIZE", "128")))
+
 # Inicializar o cliente OpenAI (certifique-se de que a chave API esteja definida no ambiente)
-client = OpenAI()
+client = OpenAI(max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "5")))
+
+def encode_base64(data):
+    """Codifica bytes em base64 e retorna o resultado como str."""
+    if pybase64_available:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('ascii')
+
+def image_data_url(data, mime_type="image/png"):
+    """
+    Monta a URL data: (base64) da imagem para a API Vision.
+    A string base64 intermediária é descartada ao sair da função, de modo que
+    apenas a URL final fica em memória enquanto a requisição é enviada.
+    """
+    return f"data:{mime_type};base64,{encode_base64(data)}"
+
+def is_scr_file(filename):
+    """Verifica pelo nome se o arquivo é um SCR/Registrato."""
+    lower_name = filename.lower()
+    return 'registrato' in lower_name or 'scr' in lower_name
+
+def iter_page_images(file_content, extension):
+    """
+    Gera as imagens das páginas do documento, uma de cada vez.
+    
+    Args:
+        file_content: Bytes do arquivo
+        extension: Extensão do arquivo (ex: '.pdf')
+        
+    Yields:
+        tuple: (bytes da imagem, tipo MIME)
+    """
+    if extension == '.pdf':
+        # Renderizar as páginas do PDF diretamente a partir dos bytes com PyMuPDF.
+        # JPEG reduz bastante o tamanho enviado em relação ao PNG sem perda de legibilidade.
+        with fitz.open(stream=file_content, filetype="pdf") as doc:
+            for page in doc:
+                # RGB sem canal alfa: o buffer de amostras fica 25% menor que o RGBA
+                pix = page.get_pixmap(dpi=150, colorspace=fitz.csRGB, alpha=False)
+                image_bytes = pix.tobytes("jpeg", jpg_quality=PAGE_JPEG_QUALITY)
+                # Liberar as amostras brutas antes de entregar a página, para que no
+                # máximo um pixmap por vez fique em memória durante a renderização
+                pix = None
+                yield image_bytes, "image/jpeg"
+    else:
+        # Para outros formatos, usar o conteúdo do arquivo diretamente como imagem
+        yield file_content, IMAGE_MIME_TYPES.get(extension, "image/png")
 
 class DocumentWrapper:
     """
@@ -29,6 +110,7 @@ class DocumentWrapper:
     def __init__(self):
         """Inicializa o wrapper."""
         self.converter = None
+        self._initialized = False
         # Verificar se o cliente OpenAI está configurado corretamente
         try:
             # Tentar obter a chave do ambiente
@@ -42,13 +124,18 @@ class DocumentWrapper:
     
     def initialize(self):
         """Verifica se as dependências necessárias estão disponíveis."""
+        # A verificação só precisa ser feita uma vez por instância
+        if self._initialized:
+            return True
+        
         try:
-            # Verificar se o pdf2image está funcionando
+            # Verificar se a chave da OpenAI está configurada
             if not self.openai_api_key:
                 logger.error("OPENAI_API_KEY não está configurada")
                 return False
                 
             logger.info("DocumentWrapper inicializado com sucesso")
+            self._initialized = True
             return True
         except ImportError as e:
             logger.error(f"Erro ao importar dependências: {str(e)}")
@@ -57,6 +144,94 @@ class DocumentWrapper:
             logger.error(f"Erro ao inicializar DocumentWrapper: {str(e)}")
             return False
     
+    def process_page(self, idx, image_bytes, filename, mime_type="image/png"):
+        """
+        Processa uma única página (imagem) com OpenAI Vision.
+        
+        Args:
+            idx: Índice da página no documento
+            image_bytes: Bytes da imagem da página
+            filename: Nome do arquivo original
+            mime_type: Tipo MIME da imagem
+            
+        Returns:
+            tuple: (idx, texto extraído da página)
+        """
+        # Criar mensagens para a API Vision
+        messages = [
+            {
+                "role": "system", 
+                "content": VISION_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": f"Analise a página {idx + 1} do documento '{filename}' e extraia todo o conteúdo textual, mantendo a estrutura e formatação. "
+                                         f"Organize em formato estruturado similar a markdown, preservando tabelas e seções."},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_data_url(image_bytes, mime_type)
+                        }
+                    }
+                ]
+            }
+        ]
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Enviando página %d de %s para a API Vision (%d bytes)", idx + 1, filename, len(image_bytes))
+        
+        # Chamar a API Vision
+        response = client.chat.completions.create(
+            model=self.vision_model,
+            messages=messages,
+            max_tokens=4000
+        )
+        
+        return idx, response.choices[0].message.content or ""
+    
+    def _extract_scr(self, file_content, filename):
+        """
+        Extrai os dados de dívida de um arquivo SCR e formata em markdown.
+        
+        Args:
+            file_content: Bytes do arquivo
+            filename: Nome do arquivo original
+            
+        Returns:
+            str: Dados do SCR em markdown estruturado
+            
+        Raises:
+            NotImplementedError: Se as dependências do processamento de SCR não estiverem disponíveis
+        """
+        try:
+            # Importar a função de processamento de SCR
+            from app.utils import extract_scr_data_from_pdf
+        except ImportError as e:
+            raise NotImplementedError(f"Erro ao importar módulo para processar SCR: {str(e)}")
+        
+        # Formatar os dados para markdown estruturado
+        formatted_text = f"## Dados SCR: {filename}\n\n"
+        
+        try:
+            scr_data = extract_scr_data_from_pdf(file_content, filename)
+        except Exception as e:
+            logger.error(f"Erro ao processar SCR estruturado: {str(e)}")
+            return formatted_text + f"**ERRO**: {str(e)}\n\n"
+        
+        if scr_data.get('erro'):
+            formatted_text += f"**ERRO**: {scr_data['erro']}\n\n"
+        
+        formatted_text += "### Dívidas Extraídas\n\n"
+        formatted_text += f"- **Dívida em dia**: R$ {scr_data['divida_em_dia']:.2f}\n"
+        formatted_text += f"- **Dívida vencida**: R$ {scr_data['divida_vencida']:.2f}\n"
+        formatted_text += f"- **Total de dívidas**: R$ {scr_data['total_dividas']:.2f}\n\n"
+        
+        # Adicionar informação sobre a extração direta
+        formatted_text += "*Nota: Estes valores foram extraídos diretamente das células C4 (dívida em dia) e D4 (dívida vencida) do arquivo SCR.*\n\n"
+        
+        return formatted_text
+    
     def convert_to_markdown(self, file_content, filename):
         """
         Converte conteúdo do arquivo para imagem e processa com OpenAI Vision.
@@ -72,143 +247,55 @@ class DocumentWrapper:
         if not self.initialize():
             return f"[ERRO: DocumentWrapper não pôde ser inicializado]"
         
-        try:
-            # Verificar se é um arquivo SCR
-            if 'registrato' in filename.lower() or 'scr' in filename.lower():
-                try:
-                    # Importar a função de processamento de SCR
-                    from app.utils import extract_scr_data_from_pdf
-                    
-                    # Processar o arquivo SCR
-                    scr_data = extract_scr_data_from_pdf(file_content, filename)
-                    
-                    # Formatar os dados para markdown estruturado
-                    formatted_text = f"## Dados SCR: {filename}\n\n"
-                    
-                    if "erro" in scr_data:
-                        formatted_text += f"**ERRO**: {scr_data['erro']}\n\n"
-                    
-                    formatted_text += "### Dívidas Extraídas\n\n"
-                    formatted_text += f"- **Dívida em dia**: R$ {scr_data['divida_em_dia']:.2f}\n"
-                    formatted_text += f"- **Dívida vencida**: R$ {scr_data['divida_vencida']:.2f}\n"
-                    formatted_text += f"- **Total de dívidas**: R$ {scr_data['total_dividas']:.2f}\n\n"
-                    
-                    # Adicionar informação sobre a extração direta
-                    formatted_text += "*Nota: Estes valores foram extraídos diretamente das células C4 (dívida em dia) e D4 (dívida vencida) do arquivo SCR.*\n\n"
-                    
-                    return formatted_text
-                    
-                except ImportError as e:
-                    logger.error(f"Erro ao importar módulo para processar SCR: {str(e)}")
-                    # Continuar com o processamento normal via Vision API
-                except Exception as e:
-                    logger.error(f"Erro ao processar SCR estruturado: {str(e)}")
-        except Exception as e:
-            logger.error(f"Erro ao processar SCR estruturado: {str(e)}")
-            return f"[ERRO: DocumentWrapper não pôde ser inicializado]"
-
-        if not self.initialize():
-            return f"[ERRO: DocumentWrapper não pôde ser inicializado]"
+        # Arquivos SCR são processados de forma estruturada, sem rasterização nem Vision
+        if is_scr_file(filename):
+            try:
+                return self._extract_scr(file_content, filename)
+            except NotImplementedError as e:
+                logger.error(str(e))
+                # Continuar com o processamento normal via Vision API
+        
+        # Reaproveitar o resultado de um upload idêntico já processado
+        cache_key = (content_hash(file_content), self.vision_model, VISION_PROMPT_VERSION)
+        cached_text = _vision_cache.get(cache_key)
+        if cached_text is not None:
+            logger.info("Resultado da Vision para %s obtido do cache", filename)
+            return cached_text
         
         try:
-            # Gerar um nome para o arquivo temporário
-            temp_id = str(uuid.uuid4())[:8]
             extension = os.path.splitext(filename)[1].lower()
             
-            # Converter para imagem
-            image_paths = []
-            
             try:
-                if extension == '.pdf':
-                    # Processar PDF - converter para imagens
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=extension) as temp_file:
-                        temp_file.write(file_content)
-                        temp_path = temp_file.name
-                    
-                    # Converter PDF para imagens
-                    poppler_path = r"C:/Users/Johan.Victor/Documents/poppler-24.08.0/Library/bin"  # Ajuste para o caminho real
-                    images = pdf2image.convert_from_path(temp_path, dpi=150, poppler_path=poppler_path)
-                    
-                    # Salvar as imagens temporariamente
-                    for i, img in enumerate(images):
-                        tmp_dir = tempfile.gettempdir()
-                        img_path = os.path.join(tmp_dir, f"doc_page_{temp_id}_{i}.png")
-                        img.save(img_path, "PNG")
-                        image_paths.append(img_path)
-                    
-                    # Remover o arquivo PDF temporário
-                    os.unlink(temp_path)
-                else:
-                    # Para outros formatos, tentar abrir como imagem diretamente
-                    tmp_dir = tempfile.gettempdir()
-                    img_path = os.path.join(tmp_dir, f"doc_image_{temp_id}{extension}")
-                    with open(img_path, 'wb') as f:
-                        f.write(file_content)
-                    image_paths.append(img_path)
-                
                 # Processar as imagens com OpenAI Vision
-                logger.info(f"Processando {filename} com OpenAI Vision, {len(image_paths)} imagens")
-                
-                # Preparar as imagens para o prompt
-                image_contents = []
-                for img_path in image_paths:
-                    with open(img_path, "rb") as img_file:
-                        base64_image = base64.b64encode(img_file.read()).decode('utf-8')
-                        image_contents.append(base64_image)
+                logger.info("Processando %s com OpenAI Vision", filename)
                 
-                # Criar mensagens para a API Vision
-                messages = [
-                    {
-                        "role": "system", 
-                        "content": "Você é um assistente especializado em extrair e formatar informações de documentos financeiros e empresariais. "
-                                  "Formate o conteúdo de maneira organizada e estruturada, similar a markdown, preservando todos os dados "
-                                  "e tabelas importantes. Mantenha a estrutura hierárquica do documento."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": f"Analise este documento '{filename}' e extraia todo o conteúdo textual, mantendo a estrutura e formatação. "
-                                                 f"Organize em formato estruturado similar a markdown, preservando tabelas e seções."}
-                        ]
-                    }
-                ]
-                
-                # Adicionar as imagens ao conteúdo do usuário
-                for base64_image in image_contents:
-                    messages[1]["content"].append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}"
-                        }
-                    })
-                
-                # Chamar a API Vision
-                response = client.chat.completions.create(
-                    model=self.vision_model,
-                    messages=messages,
-                    max_tokens=4000
-                )
-                
-                # Obter o texto processado
-                processed_text = response.choices[0].message.content
+                # Renderização e chamadas à API acontecem em pipeline: cada página é enviada
+                # assim que renderizada, enquanto as seguintes ainda estão sendo geradas.
+                # O semáforo limita quantas páginas renderizadas aguardam envio, para não
+                # acumular memória em PDFs longos.
+                pending_pages = threading.BoundedSemaphore(VISION_PARALLELISM * 2)
+                futures = []
+                results = []
+                with ThreadPoolExecutor(max_workers=VISION_PARALLELISM) as executor:
+                    for idx, (image_bytes, mime_type) in enumerate(iter_page_images(file_content, extension)):
+                        pending_pages.acquire()
+                        future = executor.submit(self.process_page, idx, image_bytes, filename, mime_type)
+                        future.add_done_callback(lambda _: pending_pages.release())
+                        futures.append(future)
+                    
+                    for future in as_completed(futures):
+                        results.append(future.result())
                 
-                # Limpar os arquivos de imagem temporários
-                for img_path in image_paths:
-                    if os.path.exists(img_path):
-                        os.unlink(img_path)
+                # Reordenar os resultados pelo índice da página
+                results.sort(key=lambda item: item[0])
+                processed_text = "\n\n".join(text for _, text in results)
+                _vision_cache.set(cache_key, processed_text)
                 
-                logger.info(f"Processamento de {filename} concluído com sucesso")
+                logger.info("Processamento de %s concluído com sucesso, %d imagens", filename, len(results))
                 return processed_text
             
             except Exception as e:
                 logger.error(f"Erro no processamento da imagem {filename}: {str(e)}", exc_info=True)
-                # Limpar os arquivos temporários em caso de erro
-                for img_path in image_paths:
-                    if os.path.exists(img_path):
-                        try:
-                            os.unlink(img_path)
-                        except:
-                            pass
                 return f"[ERRO NO PROCESSAMENTO DA IMAGEM: {str(e)}]"
             
         except Exception as e:
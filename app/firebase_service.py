@@ -3,6 +3,15 @@ from dotenv import load_dotenv
 import time
 import logging
 import datetime
+import asyncio
+import bisect
+import copy
+import functools
+import operator
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from app import json_helper
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -21,18 +30,68 @@ except ImportError as e:
     logger.error(f"Erro ao importar firebase_admin: {str(e)}")
     logger.error("As funcionalidades do Firebase não estarão disponíveis. Verifique se o pacote está instalado: pip install firebase-admin")
 
+# Mapeamento das categorias de documentos para nomes em português (somente leitura)
+NOMES_DOCUMENTOS = MappingProxyType({
+    "incomeTax": "Imposto de Renda",
+    "registration": "Registro",
+    "taxStatus": "Situação Fiscal",
+    "taxBilling": "Faturamento Fiscal",
+    "managementBilling": "Faturamento Gerencial",
+    "spcSerasa": "SPC e Serasa",
+    "statement": "Demonstrativo"
+})
+
+# Campos do planejamento gravados no relatório: (campo no Firestore, campo recebido, valor padrão)
+CAMPOS_PLANEJAMENTO = (
+    ("objetivoCredito", "objective", ""),
+    ("valorCreditoBuscado", "creditAmount", 0),
+    ("tempoEmpresa", "timeInCompany", 0),
+    ("carenciaSolicitada", "gracePeriod", 0),
+)
+
+# Estado da inicialização do Firebase: a busca de credenciais é feita uma única vez
+_firebase_lock = threading.Lock()
+_firebase_initialized = False
+
 def initialize_firebase():
     """
     Inicializa o Firebase Admin SDK para uso no backend.
     Procura por credenciais no arquivo service-account.json, nas variáveis de ambiente
     ou nas variáveis de configuração separadas.
+    Após o sucesso, as chamadas seguintes retornam imediatamente.
+    """
+    global _firebase_initialized
+    
+    # Garantir que o firebase_admin está disponível
+    if not firebase_admin_available:
+        logger.error("Firebase não disponível")
+        return False
+    
+    if _firebase_initialized:
+        return True
+    
+    with _firebase_lock:
+        if _firebase_initialized:
+            return True
+        _firebase_initialized = _initialize_firebase_app()
+        return _firebase_initialized
+
+@functools.lru_cache(maxsize=1)
+def _get_env_certificate():
+    """
+    Lê e valida as credenciais de FIREBASE_CREDENTIALS uma única vez.
+    
+    Returns:
+        credentials.Certificate: Credencial de service account, ou None se a variável não estiver definida
     """
+    raw_credentials = os.environ.get('FIREBASE_CREDENTIALS')
+    if not raw_credentials:
+        return None
+    return credentials.Certificate(json_helper.loads(raw_credentials))
+
+def _initialize_firebase_app():
+    """Localiza as credenciais e inicializa o app do Firebase Admin SDK."""
     try:
-        # Garantir que o firebase_admin está disponível
-        if not firebase_admin_available:
-            logger.error("Firebase não disponível")
-            return False
-            
         # Verificar se já está inicializado
         if firebase_admin._apps:
             logger.info("Firebase já está inicializado")
@@ -51,10 +110,8 @@ def initialize_firebase():
             return True
         
         # Método 2: Verificar se temos as credenciais completas
-        if os.getenv('FIREBASE_CREDENTIALS'):
-            import json
-            firebase_creds = json.loads(os.getenv('FIREBASE_CREDENTIALS'))
-            cred = credentials.Certificate(firebase_creds)
+        cred = _get_env_certificate()
+        if cred is not None:
             firebase_admin.initialize_app(cred)
             logger.info("Firebase inicializado via FIREBASE_CREDENTIALS")
             return True
@@ -90,109 +147,626 @@ def initialize_firebase():
         logger.error(f"Erro ao inicializar Firebase: {str(e)}")
         return False
 
+# Classes auxiliares do simulador de Firestore (definidas uma única vez no módulo)
+class SimulatedDocumentSnapshot:
+    __slots__ = ("id", "_data", "exists")
+    
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+        self.exists = data is not None
+        
+    def to_dict(self):
+        # Como no cliente real, uma cópia: alterar o resultado não afeta os dados do simulador
+        return dict(self._data) if self._data is not None else None
+
+class SimulatedQuerySnapshot:
+    __slots__ = ("docs",)
+    
+    def __init__(self, docs):
+        self.docs = docs
+    
+    def __iter__(self):
+        # Query.get() do cliente real retorna a lista de snapshots diretamente
+        return iter(self.docs)
+
+def _mesclar(atual, novo):
+    """Mescla os mapas aninhados como set(..., merge=True) do Firestore, sem alterar os originais."""
+    resultado = dict(atual)
+    for campo, valor in novo.items():
+        if isinstance(valor, dict) and isinstance(resultado.get(campo), dict):
+            valor = _mesclar(resultado[campo], valor)
+        resultado[campo] = valor
+    return resultado
+
+def _resolver_sentinelas(data):
+    """
+    Aplica os valores especiais do Firestore como o servidor faria: DELETE_FIELD remove o
+    campo e SERVER_TIMESTAMP é substituído pela hora atual (UTC).
+    """
+    if not firebase_admin_available:
+        return data
+    resultado = {}
+    for campo, valor in data.items():
+        if valor is firestore.DELETE_FIELD:
+            continue
+        if valor is firestore.SERVER_TIMESTAMP:
+            valor = datetime.datetime.now(datetime.timezone.utc)
+        elif isinstance(valor, dict):
+            valor = _resolver_sentinelas(valor)
+        resultado[campo] = valor
+    return resultado
+
+def _projetar(data, field_paths):
+    """Mantém apenas os campos pedidos (caminhos com ponto para mapas aninhados), como a projeção do Firestore."""
+    resultado = {}
+    for caminho in field_paths:
+        *pais, campo = caminho.split('.')
+        origem = data
+        for pai in pais:
+            origem = origem.get(pai) if isinstance(origem, dict) else None
+        if not isinstance(origem, dict) or campo not in origem:
+            continue
+        destino = resultado
+        for pai in pais:
+            destino = destino.setdefault(pai, {})
+        destino[campo] = origem[campo]
+    return resultado
+
+class SimulatedDocumentRef:
+    __slots__ = ("simulator", "collection_name", "id")
+    
+    def __init__(self, simulator, collection_name, doc_id):
+        self.simulator = simulator
+        self.collection_name = collection_name
+        self.id = doc_id
+        
+    def set(self, data, merge=False):
+        with self.simulator._lock:
+            self.simulator._write(self.collection_name, self.id, data, merge)
+        logger.info(f"Simulador: Documento salvo em {self.collection_name}/{self.id}")
+        return True
+    
+    def update(self, data):
+        with self.simulator._lock:
+            self.simulator._update(self.collection_name, self.id, data)
+        return True
+    
+    def get(self, field_paths=None, transaction=None):
+        with self.simulator._lock:
+            data = self.simulator.data[self.collection_name].get(self.id)
+        if data is not None and field_paths:
+            data = _projetar(data, field_paths)
+        return SimulatedDocumentSnapshot(self.id, data)
+
+class SimulatedFieldIndex:
+    """
+    Índices de um campo de uma coleção do simulador: dicionário valor -> IDs para
+    igualdade e lista ordenada de valores para consultas por faixa (via bisect).
+    """
+    
+    def __init__(self):
+        self.by_value = {}
+        self.keys = []
+        self.ids = []
+        # Fica falso se o campo tiver valores de tipos incomparáveis entre si
+        self.sortable = True
+    
+    def add(self, value, doc_id):
+        try:
+            self.by_value.setdefault(value, set()).add(doc_id)
+        except TypeError:
+            # Valores não hasheáveis nunca são iguais a um valor de consulta hasheável
+            pass
+        if self.sortable:
+            try:
+                pos = bisect.bisect_right(self.keys, value)
+            except TypeError:
+                self.sortable = False
+                self.keys, self.ids = [], []
+            else:
+                self.keys.insert(pos, value)
+                self.ids.insert(pos, doc_id)
+    
+    def discard(self, value, doc_id):
+        try:
+            ids = self.by_value.get(value)
+        except TypeError:
+            ids = None
+        if ids is not None:
+            ids.discard(doc_id)
+            if not ids:
+                del self.by_value[value]
+        if self.sortable:
+            pos = bisect.bisect_left(self.keys, value)
+            while pos < len(self.keys) and self.keys[pos] == value:
+                if self.ids[pos] == doc_id:
+                    del self.keys[pos]
+                    del self.ids[pos]
+                    break
+                pos += 1
+    
+    def candidates(self, op, value):
+        """IDs dos documentos que podem satisfazer o filtro, ou None se o índice não se aplica."""
+        try:
+            if op == "==":
+                return set(self.by_value.get(value, ()))
+            if not self.sortable:
+                return None
+            if op == ">":
+                return set(self.ids[bisect.bisect_right(self.keys, value):])
+            if op == ">=":
+                return set(self.ids[bisect.bisect_left(self.keys, value):])
+            if op == "<":
+                return set(self.ids[:bisect.bisect_left(self.keys, value)])
+            if op == "<=":
+                return set(self.ids[:bisect.bisect_right(self.keys, value)])
+        except TypeError:
+            return None
+        return None
+
+class SimulatedQueryRef:
+    # Operações básicas de comparação suportadas pela simulação
+    OPERADORES = {
+        "==": operator.eq,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le,
+    }
+    
+    def __init__(self, simulator, collection_name):
+        self.simulator = simulator
+        self.collection_name = collection_name
+        self.filters = []
+        self.order_field = None
+        self.start = None
+        self.end = None
+        self.limit_count = None
+        self.fields = None
+    
+    def _copy(self, **changes):
+        query = copy.copy(self)
+        query.filters = list(self.filters)
+        for name, value in changes.items():
+            setattr(query, name, value)
+        return query
+    
+    def _cursor_key(self, cursor):
+        # Snapshots posicionam o cursor pelo valor do campo ordenado e pelo ID (desempate)
+        if isinstance(cursor, SimulatedDocumentSnapshot):
+            return (cursor.to_dict().get(self.order_field), cursor.id)
+        if isinstance(cursor, dict):
+            return (cursor[self.order_field],)
+        return (cursor[0],)
+    
+    def where(self, field, op, value):
+        # Os filtros se acumulam (AND), como no Firestore
+        query = self._copy()
+        query.filters.append((field, op, value))
+        return query
+    
+    def order_by(self, field):
+        return self._copy(order_field=field)
+    
+    def start_at(self, cursor):
+        return self._copy(start=(self._cursor_key(cursor), True))
+    
+    def start_after(self, cursor):
+        return self._copy(start=(self._cursor_key(cursor), False))
+    
+    def end_at(self, cursor):
+        return self._copy(end=(self._cursor_key(cursor), True))
+    
+    def limit(self, count):
+        return self._copy(limit_count=count)
+    
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+    
+    def _matches(self, doc_data, filters):
+        # Para no primeiro filtro que falhar
+        for field, op, value in filters:
+            if field not in doc_data:
+                return False
+            try:
+                if not self.OPERADORES[op](doc_data[field], value):
+                    return False
+            except TypeError:
+                # Valores de tipos incomparáveis não correspondem ao filtro
+                return False
+        return True
+    
+    def _in_range(self, key):
+        try:
+            if self.start is not None:
+                cursor, inclusive = self.start
+                doc_key = key[:len(cursor)]
+                if doc_key < cursor or (doc_key == cursor and not inclusive):
+                    return False
+            if self.end is not None:
+                cursor, inclusive = self.end
+                doc_key = key[:len(cursor)]
+                if doc_key > cursor or (doc_key == cursor and not inclusive):
+                    return False
+        except TypeError:
+            return False
+        return True
+        
+    def get(self):
+        # Retorna documentos que correspondem aos filtros
+        if any(op not in self.OPERADORES for _, op, _ in self.filters):
+            return SimulatedQuerySnapshot([])
+        
+        # Copiar os itens sob o lock para não iterar enquanto outra thread grava.
+        # Os índices dos campos filtrados reduzem os candidatos antes da verificação
+        # completa dos filtros; sem índice utilizável, a coleção inteira é percorrida.
+        with self.simulator._lock:
+            collection = self.simulator.data[self.collection_name]
+            candidate_ids = None
+            for field, op, value in self.filters:
+                ids = self.simulator._index_for(self.collection_name, field).candidates(op, value)
+                if ids is not None:
+                    candidate_ids = ids if candidate_ids is None else candidate_ids & ids
+            
+            if candidate_ids is None:
+                doc_ids = sorted(collection)
+            else:
+                doc_ids = sorted(candidate_ids)
+            # Como no Firestore, sem ordenação explícita o resultado segue o ID do documento
+            items = [(doc_id, collection[doc_id]) for doc_id in doc_ids]
+        
+        # Igualdades primeiro: são as mais seletivas e descartam o documento mais cedo
+        filters = sorted(self.filters, key=lambda item: 0 if item[1] == "==" else 1)
+        matched = [(doc_id, doc_data) for doc_id, doc_data in items if self._matches(doc_data, filters)]
+        
+        if self.order_field is not None:
+            # Como no Firestore, a ordenação exclui documentos sem o campo
+            keyed = [
+                ((doc_data[self.order_field], doc_id), doc_id, doc_data)
+                for doc_id, doc_data in matched
+                if self.order_field in doc_data
+            ]
+            try:
+                keyed.sort(key=lambda item: item[0])
+            except TypeError:
+                logger.warning(f"Simulador: valores incomparáveis em {self.order_field}, ordenação ignorada")
+            matched = [
+                (doc_id, doc_data) for key, doc_id, doc_data in keyed
+                if self._in_range(key)
+            ]
+        
+        if self.limit_count is not None:
+            matched = matched[:self.limit_count]
+        
+        filtered_docs = []
+        for doc_id, doc_data in matched:
+            if self.fields is not None:
+                doc_data = {field: doc_data[field] for field in self.fields if field in doc_data}
+            filtered_docs.append(SimulatedDocumentSnapshot(doc_id, doc_data))
+        return SimulatedQuerySnapshot(filtered_docs)
+    
+    def stream(self):
+        return iter(self.get().docs)
+
+class SimulatedWriteBatch:
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self._writes = []
+        
+    def set(self, document_ref, data, merge=False):
+        self._writes.append((document_ref, data, merge))
+    
+    def delete(self, document_ref):
+        self._writes.append((document_ref, None, False))
+        
+    def commit(self):
+        # Aplicar todas as gravações de uma vez, como no lote do Firestore
+        with self.simulator._lock:
+            for document_ref, data, merge in self._writes:
+                if data is None:
+                    self.simulator._delete(document_ref.collection_name, document_ref.id)
+                else:
+                    self.simulator._write(document_ref.collection_name, document_ref.id, data, merge)
+        logger.info(f"Simulador: {len(self._writes)} documentos salvos em lote")
+        self._writes = []
+        return True
+
+class SimulatedTransaction:
+    """Transação do simulador: as gravações são aplicadas juntas no commit, como no Firestore."""
+    
+    def __init__(self, simulator):
+        self.simulator = simulator
+        self._writes = []
+    
+    def set(self, document_ref, data, merge=False):
+        self._writes.append((document_ref, data, merge, False))
+    
+    def update(self, document_ref, data):
+        self._writes.append((document_ref, data, False, True))
+    
+    def commit(self):
+        with self.simulator._lock:
+            for document_ref, data, merge, update in self._writes:
+                if update:
+                    self.simulator._update(document_ref.collection_name, document_ref.id, data)
+                else:
+                    self.simulator._write(document_ref.collection_name, document_ref.id, data, merge)
+        self._writes = []
+
+class SimulatedCollectionRef:
+    def __init__(self, simulator, collection_name):
+        self.simulator = simulator
+        self.collection_name = collection_name
+        
+    def document(self, doc_id=None):
+        if doc_id is None:
+            # Gerar ID automático
+            doc_id = self.simulator._next_auto_id()
+            
+        return SimulatedDocumentRef(self.simulator, self.collection_name, doc_id)
+        
+    def _query(self):
+        return SimulatedQueryRef(self.simulator, self.collection_name)
+        
+    def where(self, field, op, value):
+        # Simulação simplificada de consulta
+        return self._query().where(field, op, value)
+    
+    def order_by(self, field):
+        return self._query().order_by(field)
+    
+    def limit(self, count):
+        return self._query().limit(count)
+    
+    def select(self, field_paths):
+        return self._query().select(field_paths)
+    
+    def stream(self):
+        return self._query().stream()
+
 # Simulador de Firestore para desenvolvimento quando admin SDK não estiver disponível
 class FirestoreSimulator:
     def __init__(self):
         self.data = {}
+        self.indexes = {}  # {coleção: {campo: SimulatedFieldIndex}}
         self.next_id = 1
+        # Protege self.data e self.next_id entre as threads do servidor. Reentrante para que
+        # uma transação (ver run_transaction) possa ler e gravar com o lock já adquirido.
+        self._lock = threading.RLock()
         logger.info("Inicializando simulador de Firestore para desenvolvimento")
     
+    def _next_auto_id(self):
+        with self._lock:
+            doc_id = f"auto_id_{self.next_id}"
+            self.next_id += 1
+        return doc_id
+    
+    def batch(self):
+        return SimulatedWriteBatch(self)
+    
+    def transaction(self):
+        return SimulatedTransaction(self)
+    
+    def _index_for(self, collection_name, field):
+        # Deve ser chamado com self._lock adquirido. O índice de um campo é criado
+        # na primeira consulta que o utiliza e mantido a cada gravação.
+        indexes = self.indexes.setdefault(collection_name, {})
+        index = indexes.get(field)
+        if index is None:
+            index = SimulatedFieldIndex()
+            for doc_id, doc_data in self.data[collection_name].items():
+                if field in doc_data:
+                    index.add(doc_data[field], doc_id)
+            indexes[field] = index
+        return index
+    
+    def _write(self, collection_name, doc_id, data, merge=False):
+        # Deve ser chamado com self._lock adquirido
+        collection = self.data[collection_name]
+        old_data = collection.get(doc_id)
+        if merge and old_data is not None:
+            data = _mesclar(old_data, data)
+        data = _resolver_sentinelas(data)
+        for field, index in self.indexes.get(collection_name, {}).items():
+            if old_data is not None and field in old_data:
+                index.discard(old_data[field], doc_id)
+            if field in data:
+                index.add(data[field], doc_id)
+        collection[doc_id] = data
+    
+    def _delete(self, collection_name, doc_id):
+        # Deve ser chamado com self._lock adquirido
+        old_data = self.data[collection_name].pop(doc_id, None)
+        if old_data is None:
+            return
+        for field, index in self.indexes.get(collection_name, {}).items():
+            if field in old_data:
+                index.discard(old_data[field], doc_id)
+    
+    def _update(self, collection_name, doc_id, data):
+        # Deve ser chamado com self._lock adquirido. Como no Firestore, os campos podem
+        # usar caminhos com ponto ('subscription.autoRenew') e o documento deve existir.
+        if doc_id not in self.data[collection_name]:
+            raise KeyError(f"Documento {collection_name}/{doc_id} não encontrado")
+        aninhado = {}
+        for caminho, valor in data.items():
+            *pais, campo = caminho.split('.')
+            destino = aninhado
+            for pai in pais:
+                destino = destino.setdefault(pai, {})
+            destino[campo] = valor
+        self._write(collection_name, doc_id, aninhado, merge=True)
+    
+    def get_all(self, references, field_paths=None):
+        with self._lock:
+            found = [
+                (ref.id, self.data.get(ref.collection_name, {}).get(ref.id))
+                for ref in references
+            ]
+        for doc_id, data in found:
+            if data is not None and field_paths:
+                data = _projetar(data, field_paths)
+            yield SimulatedDocumentSnapshot(doc_id, data)
+    
     def collection(self, collection_name):
-        if collection_name not in self.data:
-            self.data[collection_name] = {}
-            
-        simulator = self  # Referência para uso nas classes aninhadas
+        with self._lock:
+            self.data.setdefault(collection_name, {})
             
-        class DocumentRef:
-            def __init__(self, doc_id, collection_data):
-                self.id = doc_id
-                self.collection_data = collection_data
-                
-            def set(self, data):
-                self.collection_data[self.id] = data
-                logger.info(f"Simulador: Documento salvo em {collection_name}/{self.id}")
-                return True
-                
-        class CollectionRef:
-            def document(self, doc_id=None):
-                if doc_id is None:
-                    # Gerar ID automático
-                    doc_id = f"auto_id_{simulator.next_id}"
-                    simulator.next_id += 1
-                    
-                return DocumentRef(doc_id, simulator.data[collection_name])
-                
-            def where(self, field, op, value):
-                # Simulação simplificada de consulta
-                class QueryRef:
-                    def get(self):
-                        # Retorna documentos que correspondem ao filtro
-                        class QuerySnapshot:
-                            def __init__(self, docs):
-                                self.docs = docs
-                                
-                        filtered_docs = []
-                        for doc_id, doc_data in simulator.data[collection_name].items():
-                            # Verifica se o campo existe
-                            if field in doc_data:
-                                # Simula operações básicas de comparação
-                                if op == "==" and doc_data[field] == value:
-                                    filtered_docs.append(self._create_doc_snapshot(doc_id, doc_data))
-                                elif op == ">" and doc_data[field] > value:
-                                    filtered_docs.append(self._create_doc_snapshot(doc_id, doc_data))
-                                elif op == ">=" and doc_data[field] >= value:
-                                    filtered_docs.append(self._create_doc_snapshot(doc_id, doc_data))
-                                elif op == "<" and doc_data[field] < value:
-                                    filtered_docs.append(self._create_doc_snapshot(doc_id, doc_data))
-                                elif op == "<=" and doc_data[field] <= value:
-                                    filtered_docs.append(self._create_doc_snapshot(doc_id, doc_data))
-                                    
-                        return QuerySnapshot(filtered_docs)
-                        
-                    def _create_doc_snapshot(self, doc_id, doc_data):
-                        # Cria um snapshot de documento
-                        class DocumentSnapshot:
-                            def __init__(self, id, data):
-                                self.id = id
-                                self._data = data
-                                
-                            def to_dict(self):
-                                return self._data
-                                
-                        return DocumentSnapshot(doc_id, doc_data)
-                        
-                return QueryRef()
-                
-        return CollectionRef()
+        return SimulatedCollectionRef(self, collection_name)
 
 # Variável global para o simulador
 _firestore_simulator = None
 
+# Cliente Firestore compartilhado, criado no primeiro uso
+_firestore_client = None
+
+# Limite de documentos por operação em lote imposto pelo Firestore
+FIRESTORE_BATCH_SIZE = 500
+
+# Executor dedicado às chamadas bloqueantes do Firestore, separado do executor padrão do loop
+_firestore_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FIRESTORE_WORKERS", "4")),
+    thread_name_prefix="firestore"
+)
+
 # Obter instância do Firestore
 def get_firestore_db():
-    """Retorna uma instância do banco de dados Firestore ou simulador."""
-    global _firestore_simulator
+    """
+    Retorna uma instância do banco de dados Firestore ou simulador.
+    O cliente real é criado uma única vez e reutilizado nas chamadas seguintes.
+    """
+    global _firestore_client
+    
+    if _firestore_client is not None:
+        return _firestore_client
     
     if not firebase_admin_available:
         logger.warning("Firebase não disponível, usando simulador")
-        if _firestore_simulator is None:
-            _firestore_simulator = FirestoreSimulator()
-        return _firestore_simulator
+        return _get_simulator()
     
-    if not firebase_admin._apps:
-        if not initialize_firebase():
-            logger.warning("Firebase não inicializado, usando simulador")
+    if not initialize_firebase():
+        logger.warning("Firebase não inicializado, usando simulador")
+        return _get_simulator()
+    
+    with _firebase_lock:
+        if _firestore_client is not None:
+            return _firestore_client
+        try:
+            _firestore_client = firestore.client()
+            return _firestore_client
+        except Exception as e:
+            logger.warning(f"Erro ao obter cliente Firestore: {str(e)}. Usando simulador.")
+    
+    return _get_simulator()
+
+def _get_simulator():
+    """Retorna o simulador de Firestore compartilhado, criando-o no primeiro uso."""
+    global _firestore_simulator
+    
+    if _firestore_simulator is None:
+        with _firebase_lock:
             if _firestore_simulator is None:
                 _firestore_simulator = FirestoreSimulator()
-            return _firestore_simulator
+    return _firestore_simulator
+
+def _metadados_arquivo(file_content, ts):
+    """
+    Monta os metadados de um arquivo enviado, sem o seu conteúdo.
     
-    try:
-        return firestore.client()
-    except Exception as e:
-        logger.warning(f"Erro ao obter cliente Firestore: {str(e)}. Usando simulador.")
-        if _firestore_simulator is None:
-            _firestore_simulator = FirestoreSimulator()
-        return _firestore_simulator
+    Args:
+        file_content (UploadFile): Arquivo recebido (ou objeto com filename/content_type)
+        ts (float): Timestamp do envio
+    
+    Returns:
+        dict: Metadados do arquivo
+    """
+    file_metadata = {
+        "arquivo_recebido": True,
+        "timestamp": ts
+    }
+    
+    # Se tivermos metadados adicionais (UploadFile), incluí-los
+    nome_arquivo = getattr(file_content, 'filename', None)
+    if nome_arquivo is not None:
+        file_metadata['nome_arquivo'] = nome_arquivo
+    tipo = getattr(file_content, 'content_type', None)
+    if tipo is not None:
+        file_metadata['tipo'] = tipo
+    # Tamanho informado pelo Starlette durante o upload (o conteúdo não é lido)
+    tamanho = getattr(file_content, 'size', None)
+    if tamanho is not None:
+        file_metadata['tamanho_bytes'] = tamanho
+    
+    return file_metadata
+
+def _montar_relatorio(user_id, user_name, planning_data, analysis_files=None, report_content=None):
+    """
+    Monta o documento do relatório no formato gravado no Firestore.
+    
+    Args:
+        user_id (str): ID do usuário
+        user_name (str): Nome do usuário
+        planning_data (dict): Dados do planejamento
+        analysis_files (dict, optional): Arquivos de análise. 
+        report_content (str, optional): Conteúdo do relatório em texto
+    
+    Returns:
+        dict: Dados do relatório
+    """
+    # Preparar informações sobre documentos enviados
+    documentos_enviados = {}
+    
+    # Guardar metadados dos arquivos, sem fazer upload
+    if analysis_files:
+        # Todos os arquivos pertencem ao mesmo envio e compartilham o mesmo timestamp
+        ts = time.time()
+        for doc_type, file_list in analysis_files.items():
+            if file_list:
+                # Obter nome da categoria em português e adicionar os metadados de cada arquivo
+                doc_name = NOMES_DOCUMENTOS.get(doc_type, doc_type)
+                documentos_enviados.setdefault(doc_name, []).extend(
+                    _metadados_arquivo(file_content, ts) for file_content in file_list if file_content
+                )
+    
+    # Preparar dados de planejamento
+    planejamento_inicial = {
+        campo: planning_data.get(origem, padrao) for campo, origem, padrao in CAMPOS_PLANEJAMENTO
+    }
+    planejamento_inicial["garantias"] = []
+    
+    # Usar o segmento detectado a partir do CNAE
+    if planning_data.get("segment"):
+        planejamento_inicial["segmentoEmpresa"] = planning_data.get("segment")
+    
+    # Adicionar garantias, se existirem
+    if planning_data.get("collaterals") and isinstance(planning_data["collaterals"], list):
+        for collateral in planning_data["collaterals"]:
+            if isinstance(collateral, dict):
+                garantia = {
+                    "tipo": collateral.get("type", "Não especificado"),
+                    "valor": collateral.get("value", 0)
+                }
+                planejamento_inicial["garantias"].append(garantia)
+    
+    # Ajustar campos personalizados, se presentes
+    if planning_data.get("objective") == "Outro" and planning_data.get("otherObjective"):
+        planejamento_inicial["objetivoCredito"] = planning_data.get("otherObjective", "")
+    
+    # Criar documento no Firestore
+    report_data = {
+        "usuarioId": user_id,
+        "nomeUsuario": user_name,
+        "planejamentoInicial": planejamento_inicial,
+        "documentosEnviados": documentos_enviados,
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+    
+    # Adicionar conteúdo do relatório, se existir
+    if report_content:
+        report_data["conteudoRelatorio"] = report_content
+    
+    return report_data
 
 def save_report(user_id, user_name, planning_data, analysis_files=None, report_content=None):
     """
@@ -213,100 +787,14 @@ def save_report(user_id, user_name, planning_data, analysis_files=None, report_c
         if not firebase_admin_available:
             logger.error("Módulo firebase_admin não encontrado")
             return {"success": False, "error": "Módulo firebase_admin não está disponível"}
-            
-        # Inicializar Firebase se necessário
-        if not firebase_admin._apps:
-            if not initialize_firebase():
-                return {"success": False, "error": "Firebase não inicializado"}
         
-        # Obter instância do Firestore
+        # Obter instância do Firestore (inicializa o Firebase no primeiro uso)
         db = get_firestore_db()
         if db is None:
             logger.error("Não foi possível obter instância do Firestore")
             return {"success": False, "error": "Falha ao acessar Firestore"}
         
-        # Preparar informações sobre documentos enviados
-        documentos_enviados = {}
-        
-        # Guardar metadados dos arquivos, sem fazer upload
-        if analysis_files:
-            for doc_type, file_list in analysis_files.items():
-                if file_list:
-                    # Mapeamento de nomes em português
-                    nomes_documentos = {
-                        "incomeTax": "Imposto de Renda",
-                        "registration": "Registro",
-                        "taxStatus": "Situação Fiscal",
-                        "taxBilling": "Faturamento Fiscal",
-                        "managementBilling": "Faturamento Gerencial",
-                        "spcSerasa": "SPC e Serasa",
-                        "statement": "Demonstrativo"
-                    }
-                    
-                    # Obter nome da categoria em português
-                    doc_name = nomes_documentos.get(doc_type, doc_type)
-                    
-                    # Inicializar lista para esta categoria se ainda não existir
-                    if doc_name not in documentos_enviados:
-                        documentos_enviados[doc_name] = []
-                    
-                    # Processar cada arquivo na lista
-                    for idx, file_content in enumerate(file_list):
-                        if file_content:
-                            # Criar metadados para cada arquivo
-                            file_metadata = {
-                                "arquivo_recebido": True,
-                                "timestamp": time.time()
-                            }
-                            
-                            # Se tivermos metadados adicionais, incluí-los
-                            if hasattr(file_content, 'filename'):
-                                file_metadata['nome_arquivo'] = file_content.filename
-                            if hasattr(file_content, 'content_type'):
-                                file_metadata['tipo'] = file_content.content_type
-                            
-                            # Adicionar à lista de arquivos desta categoria
-                            documentos_enviados[doc_name].append(file_metadata)
-        
-        # Preparar dados de planejamento
-        planejamento_inicial = {
-            "objetivoCredito": planning_data.get("objective", ""),
-            "valorCreditoBuscado": planning_data.get("creditAmount", 0),
-            "tempoEmpresa": planning_data.get("timeInCompany", 0),
-            "carenciaSolicitada": planning_data.get("gracePeriod", 0),
-            "garantias": []
-        }
-        
-        # Usar o segmento detectado a partir do CNAE
-        if planning_data.get("segment"):
-            planejamento_inicial["segmentoEmpresa"] = planning_data.get("segment")
-        
-        # Adicionar garantias, se existirem
-        if planning_data.get("collaterals") and isinstance(planning_data["collaterals"], list):
-            for collateral in planning_data["collaterals"]:
-                if isinstance(collateral, dict):
-                    garantia = {
-                        "tipo": collateral.get("type", "Não especificado"),
-                        "valor": collateral.get("value", 0)
-                    }
-                    planejamento_inicial["garantias"].append(garantia)
-        
-        # Ajustar campos personalizados, se presentes
-        if planning_data.get("objective") == "Outro" and planning_data.get("otherObjective"):
-            planejamento_inicial["objetivoCredito"] = planning_data.get("otherObjective", "")
-        
-        # Criar documento no Firestore
-        report_data = {
-            "usuarioId": user_id,
-            "nomeUsuario": user_name,
-            "planejamentoInicial": planejamento_inicial,
-            "documentosEnviados": documentos_enviados,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        }
-        
-        # Adicionar conteúdo do relatório, se existir
-        if report_content:
-            report_data["conteudoRelatorio"] = report_content
+        report_data = _montar_relatorio(user_id, user_name, planning_data, analysis_files, report_content)
         
         # Salvar no Firestore
         report_ref = db.collection("relatorios").document()
@@ -315,12 +803,189 @@ def save_report(user_id, user_name, planning_data, analysis_files=None, report_c
         logger.info(f"Relatório salvo no Firestore com ID: {report_ref.id}")
         return {"success": True, "report_id": report_ref.id}
     except Exception as e:
-        import traceback
-        logger.error(f"Erro ao salvar relatório: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Erro ao salvar relatório", extra={"user_id": user_id})
         return {"success": False, "error": str(e)}
 
-def get_reports_by_date_range(user_id=None, start_date=None, end_date=None):
+async def _run_in_firestore_executor(func, *args, **kwargs):
+    """Executa uma chamada bloqueante do SDK do Firestore no executor dedicado."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_firestore_executor, functools.partial(func, *args, **kwargs))
+
+async def save_report_async(user_id, user_name, planning_data, analysis_files=None, report_content=None):
+    """
+    Versão assíncrona de save_report para uso nos endpoints.
+    A gravação no Firestore é bloqueante, então é executada em uma thread
+    para não travar o loop de eventos durante o round-trip.
+    
+    Returns:
+        dict: Resultado da operação
+    """
+    return await _run_in_firestore_executor(
+        save_report, user_id, user_name, planning_data, analysis_files, report_content
+    )
+
+def new_payment_id():
+    """
+    Gera o ID de um novo documento em 'pagamentos'. O ID é criado localmente pelo
+    cliente, sem round-trip ao Firestore.
+    """
+    return get_firestore_db().collection('pagamentos').document().id
+
+def register_pending_payment(payment_id, user_id, payment_data, payment_date):
+    """
+    Registra em 'pagamentos_pendentes' um pagamento que ainda será gravado por
+    save_payment. O registro é removido no mesmo lote da gravação; os que restarem
+    (falha ou processo encerrado antes do commit) são regravados por replay_pending_payments.
+    """
+    get_firestore_db().collection('pagamentos_pendentes').document(payment_id).set({
+        'userId': user_id,
+        'paymentData': payment_data,
+        'paymentDate': payment_date,
+        'criadoEm': firestore.SERVER_TIMESTAMP if firebase_admin_available else datetime.datetime.now(datetime.timezone.utc)
+    })
+
+async def register_pending_payment_async(payment_id, user_id, payment_data, payment_date):
+    """Versão assíncrona de register_pending_payment, executada fora do loop de eventos."""
+    return await _run_in_firestore_executor(register_pending_payment, payment_id, user_id, payment_data, payment_date)
+
+def save_payment(user_id, payment_data, payment_date, payment_id=None):
+    """
+    Grava o pagamento na coleção 'pagamentos' e a referência a ele no documento do
+    usuário em um único lote: um round-trip, e as duas gravações são aplicadas juntas.
+    Com payment_id (ver new_payment_id) a gravação pode ser repetida sem duplicar o
+    pagamento, e o registro pendente correspondente é removido no mesmo lote.
+    
+    Returns:
+        str: ID do pagamento criado
+    """
+    db = get_firestore_db()
+    pagamento_ref = db.collection('pagamentos').document(payment_id)
+    usuario_ref = db.collection('usuarios').document(user_id)
+    
+    batch = db.batch()
+    if payment_id is not None:
+        batch.delete(db.collection('pagamentos_pendentes').document(payment_id))
+    batch.set(pagamento_ref, payment_data)
+    batch.set(usuario_ref, {
+        'temPlano': True,
+        'pagamentos': {
+            pagamento_ref.id: {
+                'data': payment_date
+            }
+        }
+    }, merge=True)
+    batch.commit()
+    return pagamento_ref.id
+
+async def save_payment_async(user_id, payment_data, payment_date, payment_id=None):
+    """Versão assíncrona de save_payment, executada fora do loop de eventos."""
+    return await _run_in_firestore_executor(save_payment, user_id, payment_data, payment_date, payment_id)
+
+def replay_pending_payments():
+    """
+    Regrava os pagamentos que ficaram em 'pagamentos_pendentes'. Como save_payment é
+    idempotente para um mesmo ID, regravar um pagamento já concluído não o duplica.
+    
+    Returns:
+        int: Número de pagamentos regravados
+    """
+    regravados = 0
+    for doc in get_firestore_db().collection('pagamentos_pendentes').stream():
+        pendente = doc.to_dict() or {}
+        try:
+            save_payment(pendente['userId'], pendente['paymentData'], pendente['paymentDate'], doc.id)
+            regravados += 1
+        except Exception as e:
+            logger.error(f"Erro ao regravar pagamento pendente {doc.id}: {str(e)}")
+    return regravados
+
+async def replay_pending_payments_async():
+    """Versão assíncrona de replay_pending_payments, executada fora do loop de eventos."""
+    return await _run_in_firestore_executor(replay_pending_payments)
+
+def run_transaction(func, *args):
+    """
+    Executa func(transaction, *args) em uma transação do Firestore: as leituras feitas com
+    a transação são verificadas no commit e a função é repetida se o documento mudar.
+    No simulador, a função roda com o lock do simulador adquirido.
+    
+    Returns:
+        O valor retornado por func
+    """
+    db = get_firestore_db()
+    if isinstance(db, FirestoreSimulator):
+        with db._lock:
+            transaction = db.transaction()
+            resultado = func(transaction, *args)
+            transaction.commit()
+            return resultado
+    return firestore.transactional(func)(db.transaction(), *args)
+
+def get_user_data(user_id, field_paths=None):
+    """
+    Busca os dados do usuário na coleção 'usuarios'.
+    
+    Args:
+        user_id (str): ID do usuário
+        field_paths (list, optional): Campos a buscar (ex.: 'subscription.endDate');
+            apenas eles são transferidos do Firestore
+    
+    Returns:
+        dict: Dados do usuário, ou None se ele não estiver cadastrado
+    """
+    user_doc = get_firestore_db().collection('usuarios').document(user_id).get(field_paths=field_paths)
+    return user_doc.to_dict() if user_doc.exists else None
+
+async def get_user_data_async(user_id, field_paths=None):
+    """Versão assíncrona de get_user_data, executada fora do loop de eventos."""
+    return await _run_in_firestore_executor(get_user_data, user_id, field_paths)
+
+def _build_reports_query(db, user_id=None, start_date=None, end_date=None, fields=None, page_size=None, start_after=None):
+    """
+    Monta a consulta de relatórios por intervalo de datas.
+    A consulta usa o índice composto (usuarioId, timestamp) declarado em firestore.indexes.json.
+    
+    Returns:
+        Consulta do Firestore, ou None se o relatório de start_after não existir
+    """
+    # Definir datas padrão (hoje) se não forem especificadas
+    if not start_date:
+        start_date = datetime.datetime.now().date()
+    if not end_date:
+        end_date = datetime.datetime.now().date()
+        
+    # Converter para datetime com hora inicial e final do dia
+    start_datetime = datetime.datetime.combine(start_date, datetime.time.min)
+    end_datetime = datetime.datetime.combine(end_date, datetime.time.max)
+    
+    # Consulta base na coleção de relatórios
+    collection_ref = db.collection("relatorios")
+    query_ref = collection_ref
+    
+    # Filtrar por usuário se especificado
+    if user_id:
+        query_ref = query_ref.where("usuarioId", "==", user_id)
+    
+    # Intervalo de datas como uma única faixa sobre o campo ordenado
+    query_ref = query_ref.order_by("timestamp").start_at([start_datetime]).end_at([end_datetime])
+    
+    # Continuar a partir do último relatório da página anterior
+    if start_after:
+        last_doc = collection_ref.document(start_after).get()
+        if not last_doc.exists:
+            return None
+        query_ref = query_ref.start_after(last_doc)
+    
+    if page_size:
+        query_ref = query_ref.limit(page_size)
+    
+    # Projetar apenas os campos pedidos (evita trafegar o conteúdo completo dos relatórios)
+    if fields:
+        query_ref = query_ref.select(fields)
+    
+    return query_ref
+
+def get_reports_by_date_range(user_id=None, start_date=None, end_date=None, fields=None, page_size=None, start_after=None):
     """
     Busca relatórios no Firestore dentro de um intervalo de datas.
     
@@ -328,6 +993,9 @@ def get_reports_by_date_range(user_id=None, start_date=None, end_date=None):
         user_id (str, optional): ID do usuário para filtrar apenas seus relatórios
         start_date (datetime.date, optional): Data inicial do intervalo
         end_date (datetime.date, optional): Data final do intervalo
+        fields (list, optional): Campos a retornar de cada relatório (todos, se não informado)
+        page_size (int, optional): Número máximo de relatórios retornados
+        start_after (str, optional): ID do último relatório da página anterior
     
     Returns:
         dict: Relatórios encontrados ou mensagem de erro
@@ -338,46 +1006,25 @@ def get_reports_by_date_range(user_id=None, start_date=None, end_date=None):
             logger.error("Módulo firebase_admin não encontrado")
             return {"success": False, "error": "Módulo firebase_admin não está disponível", "reports": []}
             
-        # Inicializar Firebase se necessário
-        if not firebase_admin._apps:
-            if not initialize_firebase():
-                return {"success": False, "error": "Firebase não inicializado", "reports": []}
-        
-        # Obter instância do Firestore
+        # Obter instância do Firestore (inicializa o Firebase no primeiro uso)
         db = get_firestore_db()
         if db is None:
             logger.error("Não foi possível obter instância do Firestore")
             return {"success": False, "error": "Falha ao acessar Firestore", "reports": []}
         
-        # Definir datas padrão (hoje) se não forem especificadas
-        if not start_date:
-            start_date = datetime.datetime.now().date()
-        if not end_date:
-            end_date = datetime.datetime.now().date()
-            
-        # Converter para datetime com hora inicial e final do dia
-        start_datetime = datetime.datetime.combine(start_date, datetime.time.min)
-        end_datetime = datetime.datetime.combine(end_date, datetime.time.max)
-        
-        # Consulta base na coleção de relatórios
-        query_ref = db.collection("relatorios")
-        
-        # Filtrar por usuário se especificado
-        if user_id:
-            query_ref = query_ref.where("usuarioId", "==", user_id)
-        
-        # Filtrar por intervalo de datas
-        query_ref = query_ref.where("timestamp", ">=", start_datetime)
-        query_ref = query_ref.where("timestamp", "<=", end_datetime)
+        # Montar a consulta (datas padrão, faixa de timestamp, paginação e projeção)
+        query_ref = _build_reports_query(db, user_id, start_date, end_date, fields, page_size, start_after)
+        if query_ref is None:
+            return {"success": False, "error": f"Relatório {start_after} não encontrado", "reports": []}
         
         # Executar a consulta
         reports = []
-        for doc in query_ref.get().docs:
+        for doc in query_ref.get():
             report_data = doc.to_dict()
             report_data["id"] = doc.id  # Adicionar o ID do documento
             reports.append(report_data)
             
-        logger.info(f"Encontrados {len(reports)} relatórios no intervalo de {start_date} a {end_date}")
+        logger.info(f"Encontrados {len(reports)} relatórios no intervalo de {start_date or 'hoje'} a {end_date or 'hoje'}")
         
         if not reports:
             return {
@@ -385,11 +1032,90 @@ def get_reports_by_date_range(user_id=None, start_date=None, end_date=None):
                 "message": "Nenhum relatório encontrado para o período especificado", 
                 "reports": []
             }
+        
+        result = {"success": True, "reports": reports}
+        
+        # Página cheia: pode haver mais relatórios a partir do último ID
+        if page_size and len(reports) == page_size:
+            result["next_cursor"] = reports[-1]["id"]
             
-        return {"success": True, "reports": reports}
+        return result
+        
+    except Exception as e:
+        logger.exception("Erro ao buscar relatórios", extra={"user_id": user_id})
+        return {"success": False, "error": str(e), "reports": []}
+
+async def get_reports_by_date_range_async(user_id=None, start_date=None, end_date=None, fields=None, page_size=None, start_after=None):
+    """Versão assíncrona de get_reports_by_date_range, executada fora do loop de eventos."""
+    return await _run_in_firestore_executor(
+        get_reports_by_date_range, user_id, start_date, end_date,
+        fields=fields, page_size=page_size, start_after=start_after
+    )
+
+def get_reports_by_ids(ids, fields=None):
+    """
+    Busca vários relatórios pelos IDs com db.get_all, em uma requisição por
+    bloco de até FIRESTORE_BATCH_SIZE documentos (em vez de um get() por relatório).
+    
+    Args:
+        ids (list): IDs dos relatórios
+        fields (list, optional): Campos a retornar de cada relatório (todos, se não informado)
+    
+    Returns:
+        dict: Relatórios encontrados, na ordem dos IDs, e os IDs inexistentes
+    """
+    try:
+        if not firebase_admin_available:
+            logger.error("Módulo firebase_admin não encontrado")
+            return {"success": False, "error": "Módulo firebase_admin não está disponível", "reports": []}
+        
+        db = get_firestore_db()
+        if db is None:
+            logger.error("Não foi possível obter instância do Firestore")
+            return {"success": False, "error": "Falha ao acessar Firestore", "reports": []}
+        
+        # get_all não garante a ordem das respostas nem repete IDs duplicados
+        unique_ids = list(dict.fromkeys(ids))
+        collection_ref = db.collection("relatorios")
+        found = {}
+        for start in range(0, len(unique_ids), FIRESTORE_BATCH_SIZE):
+            refs = [collection_ref.document(doc_id) for doc_id in unique_ids[start:start + FIRESTORE_BATCH_SIZE]]
+            for doc in db.get_all(refs, field_paths=fields):
+                if doc.exists:
+                    report_data = doc.to_dict()
+                    report_data["id"] = doc.id  # Adicionar o ID do documento
+                    found[doc.id] = report_data
         
+        reports = [found[doc_id] for doc_id in unique_ids if doc_id in found]
+        missing = [doc_id for doc_id in unique_ids if doc_id not in found]
+        logger.info(f"Encontrados {len(reports)} de {len(unique_ids)} relatórios solicitados")
+        return {"success": True, "reports": reports, "missing_ids": missing}
     except Exception as e:
-        import traceback
-        logger.error(f"Erro ao buscar relatórios: {str(e)}")
-        traceback.print_exc()
-        return {"success": False, "error": str(e), "reports": []}
\ No newline at end of file
+        logger.exception("Erro ao buscar relatórios por ID")
+        return {"success": False, "error": str(e), "reports": []}
+
+def iter_reports_by_date_range(user_id=None, start_date=None, end_date=None, fields=None, page_size=None, start_after=None):
+    """
+    Gera os relatórios do intervalo de datas um a um, à medida que chegam do Firestore,
+    sem materializar o resultado completo em memória.
+    Recebe os mesmos argumentos de get_reports_by_date_range.
+    
+    Yields:
+        dict: Dados de cada relatório, com o ID do documento em "id"
+    
+    Raises:
+        RuntimeError: Se o Firestore não estiver disponível
+        LookupError: Se o relatório de start_after não existir
+    """
+    db = get_firestore_db()
+    if db is None:
+        raise RuntimeError("Falha ao acessar Firestore")
+    
+    query_ref = _build_reports_query(db, user_id, start_date, end_date, fields, page_size, start_after)
+    if query_ref is None:
+        raise LookupError(f"Relatório {start_after} não encontrado")
+    
+    for doc in query_ref.stream():
+        report_data = doc.to_dict()
+        report_data["id"] = doc.id  # Adicionar o ID do documento
+        yield report_data
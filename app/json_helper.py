@@ -0,0 +1,42 @@
+"""
+Helper para serialização JSON
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tentar importar o orjson (serialização JSON mais rápida)
+try:
+    import orjson
+    orjson_available = True
+except ImportError:
+    orjson_available = False
+    logger.info("orjson não encontrado. Usando o módulo json padrão.")
+
+def loads(data):
+    """
+    Decodifica um documento JSON (str ou bytes).
+    Erros de decodificação são sempre subclasses de json.JSONDecodeError.
+    """
+    if orjson_available:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(obj, default=None):
+    """
+    Codifica um objeto em JSON e retorna o resultado como str.
+    `default` é chamado para os tipos que o codificador não suporta.
+    """
+    if orjson_available:
+        return orjson.dumps(obj, default=default).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, default=default)
+
+def dumps_bytes(obj, default=None):
+    """
+    Codifica um objeto em JSON e retorna o resultado em bytes UTF-8,
+    sem passar por str quando o orjson está disponível.
+    """
+    if orjson_available:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
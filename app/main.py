@@ -1,25 +1,37 @@
 import re
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Body, Request, Query, Depends, Header
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Body, Request, Response, Query, Depends, Header, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
 from typing import List, Optional, Dict, Any
-from openai import OpenAI
-from .utils import extract_text_from_document
+from openai import AsyncOpenAI
+import httpx
+from .utils import (
+    extract_text_from_bytes, init_extraction_worker, detectar_tipo_conteudo, mesmo_extrator,
+    SUPPORTED_CONTENT_TYPES, TAMANHO_CABECALHO
+)
 import os
 import logging
 import json
 import io
-import tempfile
+import asyncio
+import functools
+import itertools
+import multiprocessing
+import secrets
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 import datetime
 import tiktoken
-import stripe
-import firestore
+from app import json_helper
+from app.cache_helper import LRUCache, content_hash
 
 # Importar módulos Firebase
 try:
-    from app.firebase_service import initialize_firebase, save_report, get_reports_by_date_range, firebase_admin_available
+    from app.firebase_service import initialize_firebase, save_report_async, save_payment_async, new_payment_id, register_pending_payment_async, replay_pending_payments_async, get_user_data_async, get_reports_by_date_range_async, iter_reports_by_date_range, get_firestore_db, firebase_admin_available
     firebase_available = True
 except ImportError:
     firebase_available = False
@@ -30,7 +42,8 @@ try:
     from app.stripe_service import (
         init_stripe, criar_cliente, criar_sessao_checkout, criar_assinatura,
         processar_webhook, listar_cartoes, adicionar_cartao, remover_cartao,
-        atualizar_cartao_padrao, consumir_relatorio, obter_historico_pagamentos, criar_pagamento_pix
+        atualizar_cartao_padrao, consumir_relatorio, obter_historico_pagamentos, criar_pagamento_pix,
+        cancelar_assinatura_usuario, executar_em_thread
     )
     stripe_available = True
 except ImportError:
@@ -44,9 +57,96 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Inicialização e encerramento da aplicação"""
+    await startup_event()
+    yield
+    await shutdown_event()
+
+# Respostas JSON serializadas com orjson quando disponível
+JSON_RESPONSE_CLASS = ORJSONResponse if json_helper.orjson_available else JSONResponse
+
+app = FastAPI(lifespan=lifespan, default_response_class=JSON_RESPONSE_CLASS)
+
+def json_response(content, headers: Optional[Dict[str, str]] = None) -> Response:
+    """
+    Resposta JSON para conteúdo que já contém apenas tipos nativos (str, números, listas
+    e dicts), serializado diretamente sem a conversão do jsonable_encoder do FastAPI.
+    """
+    return JSON_RESPONSE_CLASS(content, headers=headers)
+
+def firebase_pronto() -> bool:
+    """Indica se o Firebase foi inicializado no startup da aplicação"""
+    return getattr(app.state, "firebase_initialized", False)
 
-# Configurar CORS para seu frontend (em produção coloque o domínio específico)
+# Limites de tamanho dos uploads da análise (por arquivo e por requisição)
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_BYTES", str(25 * 1024 * 1024)))
+MAX_TOTAL_BYTES = int(os.getenv("MAX_TOTAL_BYTES", str(100 * 1024 * 1024)))
+
+# Tamanho máximo do corpo de qualquer requisição: o total dos uploads mais uma folga
+# para os campos do formulário
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(MAX_TOTAL_BYTES + 1024 * 1024)))
+
+class LimiteTamanhoRequisicao:
+    """
+    Middleware ASGI que rejeita com 413 as requisições maiores que max_bytes antes que o
+    corpo seja gravado nos arquivos temporários dos uploads. O Content-Length é conferido
+    antes da leitura; corpos sem Content-Length (chunked) são contados durante a leitura.
+    """
+    
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            response = JSONResponse(
+                status_code=413,
+                content={"detail": f"Requisição excede o limite de {self.max_bytes // (1024 * 1024)} MB."}
+            )
+            return await response(scope, receive, send)
+        
+        recebidos = 0
+        
+        async def receive_limitado():
+            nonlocal recebidos
+            message = await receive()
+            if message["type"] == "http.request":
+                recebidos += len(message.get("body", b""))
+                if recebidos > self.max_bytes:
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Requisição excede o limite de {self.max_bytes // (1024 * 1024)} MB."
+                    )
+            return message
+        
+        await self.app(scope, receive_limitado, send)
+
+app.add_middleware(LimiteTamanhoRequisicao, max_bytes=MAX_REQUEST_BYTES)
+
+class GZipExcetoStreaming(GZipMiddleware):
+    """
+    Compressão gzip das respostas, exceto nos endpoints de streaming: o GZipMiddleware
+    acumula os trechos no compressor e atrasaria os eventos enviados ao cliente.
+    """
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].endswith("/stream/"):
+            return await self.app(scope, receive, send)
+        await super().__call__(scope, receive, send)
+
+# Respostas de análise (markdown longo) e listas de relatórios são texto bem compressível.
+# Nível 5: quase a mesma taxa de compressão do nível 9 com bem menos CPU.
+app.add_middleware(GZipExcetoStreaming, minimum_size=1024, compresslevel=5)
+
+# Configurar CORS para seu frontend (em produção coloque o domínio específico).
+# Adicionado por último para ser o middleware mais externo: as respostas 413 também
+# recebem os cabeçalhos de CORS.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -54,13 +154,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Instancia o client OpenAI
+# Número de novas tentativas do SDK da OpenAI em erros transitórios (429, 5xx, timeouts),
+# com espera exponencial entre elas
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+
+# Instancia o client OpenAI (assíncrono, com um pool de conexões HTTP compartilhado
+# entre as requisições para reaproveitar as conexões TLS com a API)
 client = None
 api_key = os.getenv("OPENAI_API_KEY")
 
 try:
     if api_key:
-        client = OpenAI(api_key=api_key)
+        client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                timeout=httpx.Timeout(600.0, connect=10.0)
+            )
+        )
         logger.info("Cliente OpenAI inicializado com sucesso")
     else:
         logger.error("OPENAI_API_KEY não encontrada nas variáveis de ambiente")
@@ -68,30 +180,139 @@ try:
 except Exception as e:
     logger.warning(f"Não foi possível inicializar o cliente OpenAI: {str(e)}")
 
-def load_prompt_from_file(prompt_file_path: str = "prompt.txt", format: str = "txt") -> str:
-    """Carrega o prompt do sistema a partir de um arquivo txt"""
-    try:
-        # Caminhos possíveis considerando a estrutura: app/ contém os arquivos Python
-        current_dir = Path(__file__).parent  # diretório app/
-        root_dir = current_dir.parent  # diretório raiz do projeto
-        
-        possible_paths = [
-            current_dir / prompt_file_path,  # app/prompt.txt
-            root_dir / prompt_file_path,     # raiz/prompt.txt
-            current_dir / "prompts" / prompt_file_path,  # app/prompts/prompt.txt
-            root_dir / "prompts" / prompt_file_path,     # raiz/prompts/prompt.txt
-        ]
-        
-        for path in possible_paths:
-            if path.exists():
-                with open(path, 'r', encoding='utf-8') as f:
-                    prompt = f.read().strip()
-                    logger.info(f"Prompt carregado de: {path}")
-                    return prompt
-        
-        # Se não encontrou o arquivo, usar um prompt padrão
-        logger.warning(f"Arquivo de prompt não encontrado nos caminhos: {[str(p) for p in possible_paths]}")
-        return """Você é um analista financeiro especializado em análise de documentos empresariais.
+# Pool de processos para a extração de texto (PDF/OCR), criado no startup da aplicação
+_extraction_pool = None
+
+# Os processos do pool não podem ser criados com fork: o processo principal já tem o canal
+# gRPC do Firestore, o pool do httpx e as threads dos executores, e um fork de um processo
+# com threads pode travar ou derrubar os filhos. Com forkserver (ou spawn, onde forkserver
+# não existe) os processos partem de um interpretador limpo.
+EXTRACTION_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+def get_extraction_pool():
+    """Retorna o pool de processos da extração de texto, criando-o no primeiro uso."""
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context(EXTRACTION_START_METHOD),
+            initializer=init_extraction_worker
+        )
+    return _extraction_pool
+
+# Limite de extrações enviadas ao pool de processos (em execução ou na fila), somando todas
+# as requisições: evita acumular na fila os bytes de muitos arquivos ao mesmo tempo
+EXTRACTION_QUEUE_LIMIT = int(os.getenv("EXTRACTION_QUEUE_LIMIT", str((os.cpu_count() or 1) * 2)))
+_extraction_semaphore = None
+
+def get_extraction_semaphore():
+    """Retorna o semáforo das extrações no pool de processos, criando-o no primeiro uso."""
+    global _extraction_semaphore
+    if _extraction_semaphore is None:
+        _extraction_semaphore = asyncio.Semaphore(EXTRACTION_QUEUE_LIMIT)
+    return _extraction_semaphore
+
+# Versão dos extratores de texto: alterar ao mudar a extração para invalidar o cache
+EXTRACTION_VERSION = 1
+
+# Extrações em andamento por chave de cache: arquivos idênticos compartilham a extração
+_extraction_inflight = {}
+
+# Número máximo de arquivos de uma mesma requisição extraídos simultaneamente
+# (por padrão, o número de processos do pool de extração)
+EXTRACTION_PARALLELISM = int(os.getenv("EXTRACTION_PARALLELISM", str(os.cpu_count() or 4)))
+
+# Cache do texto extraído por (hash do conteúdo, tipo): reenvios do mesmo arquivo não repetem o OCR
+_extraction_cache = LRUCache(
+    maxsize=int(os.getenv("EXTRACTION_CACHE_SIZE", "256")),
+    ttl=30 * 24 * 3600
+)
+
+# Limite de chamadas simultâneas à OpenAI (criado no loop de eventos da aplicação)
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+_openai_semaphore = None
+
+def get_openai_semaphore():
+    """Retorna o semáforo das chamadas à OpenAI, criando-o no primeiro uso."""
+    global _openai_semaphore
+    if _openai_semaphore is None:
+        _openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+    return _openai_semaphore
+
+# Análises em andamento por chave de cache: requisições idênticas simultâneas compartilham a chamada.
+# Análises diferentes não são agrupadas em uma mesma chamada: cada prompt pode ocupar quase
+# toda a janela de contexto do modelo e a resposta é um relatório longo em markdown.
+_analysis_inflight = {}
+
+# Cache das análises da OpenAI por hash do modelo + prompts
+_analysis_cache = LRUCache(
+    maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "128")),
+    ttl=int(os.getenv("ANALYSIS_CACHE_TTL", str(24 * 3600)))
+)
+
+async def executar_no_pool(func, *args):
+    """Executa uma função de extração (limitada por CPU) no pool de processos, fora do loop de eventos"""
+    loop = asyncio.get_running_loop()
+    async with get_extraction_semaphore():
+        return await loop.run_in_executor(get_extraction_pool(), func, *args)
+
+async def _extrair_no_pool(content: bytes, content_type: str, filename: str, cache_key: tuple) -> str:
+    """Executa a extração no pool de processos e guarda o resultado no cache"""
+    text = await executar_no_pool(extract_text_from_bytes, content, content_type, filename)
+    
+    # Não guardar falhas de OCR, que retornam a mensagem de erro como texto
+    if not text.startswith("[Erro"):
+        _extraction_cache.set(cache_key, text)
+    return text
+
+# A partir deste tamanho o hash do upload é calculado em uma thread: BLAKE3/BLAKE2b liberam o
+# GIL em entradas grandes, então o loop de eventos segue atendendo enquanto o arquivo é lido
+HASH_THREAD_MIN_BYTES = 1024 * 1024
+
+async def hash_do_upload(content: bytes) -> str:
+    """Hash do conteúdo do upload, fora do loop de eventos para arquivos grandes"""
+    if len(content) < HASH_THREAD_MIN_BYTES:
+        return content_hash(content)
+    return await asyncio.get_running_loop().run_in_executor(None, content_hash, content)
+
+async def extrair_texto(content: bytes, content_type: str, filename: str) -> str:
+    """Extrai o texto de um arquivo no pool de processos, reaproveitando o resultado de uploads idênticos"""
+    cache_key = (EXTRACTION_VERSION, await hash_do_upload(content), content_type)
+    text = _extraction_cache.get(cache_key)
+    if text is not None:
+        logger.info(f"Texto de {filename} obtido do cache de extração")
+        return text
+    
+    # O mesmo arquivo já está sendo extraído (ex.: enviado duas vezes): aguardar o mesmo resultado
+    task = _extraction_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_extrair_no_pool(content, content_type, filename, cache_key))
+        _extraction_inflight[cache_key] = task
+        task.add_done_callback(lambda _: _extraction_inflight.pop(cache_key, None))
+    else:
+        logger.info(f"Extração idêntica a {filename} em andamento, aguardando o resultado")
+    return await asyncio.shield(task)
+
+# Em desenvolvimento, recarregar o prompt automaticamente quando o arquivo for alterado
+PROMPT_AUTO_RELOAD = os.getenv("PROMPT_AUTO_RELOAD", "").lower() in ("1", "true")
+
+# Caminho e data de modificação do último arquivo de prompt carregado
+_prompt_source = None
+
+# Caminhos possíveis do prompt considerando a estrutura: app/ contém os arquivos Python
+_APP_DIR = Path(__file__).parent  # diretório app/
+_ROOT_DIR = _APP_DIR.parent  # diretório raiz do projeto
+PROMPT_CANDIDATOS = (
+    _APP_DIR / "prompt.txt",               # app/prompt.txt
+    _ROOT_DIR / "prompt.txt",              # raiz/prompt.txt
+    _APP_DIR / "prompts" / "prompt.txt",   # app/prompts/prompt.txt
+    _ROOT_DIR / "prompts" / "prompt.txt",  # raiz/prompts/prompt.txt
+)
+
+# Prompt usado quando nenhum arquivo de prompt é encontrado
+PROMPT_PADRAO = """Você é um analista financeiro especializado em análise de documentos empresariais.
 
 Analise os documentos fornecidos e forneça um relatório detalhado que inclua:
 
@@ -102,16 +323,102 @@ Analise os documentos fornecidos e forneça um relatório detalhado que inclua:
 5. **Observações**: Qualquer irregularidade ou ponto importante identificado
 
 Seja objetivo, profissional e destaque os pontos mais importantes."""
-        
+
+@functools.lru_cache(maxsize=1)
+def resolve_prompt_path() -> Optional[Path]:
+    """
+    Caminho do arquivo de prompt, resolvido uma única vez: a variável PROMPT_PATH, se
+    definida, ou o primeiro dos caminhos candidatos que existir.
+    """
+    env_path = os.getenv("PROMPT_PATH")
+    if env_path:
+        return Path(env_path)
+    return next((path for path in PROMPT_CANDIDATOS if path.is_file()), None)
+
+@functools.lru_cache(maxsize=1)
+def load_prompt_from_file() -> str:
+    """
+    Carrega o prompt do sistema a partir do arquivo txt.
+    O resultado fica em cache; use /admin/reload-prompt (por processo) ou
+    PROMPT_AUTO_RELOAD (todos os workers) para recarregar.
+    """
+    global _prompt_source
+    path = resolve_prompt_path()
+    if path is None:
+        # Se não encontrou o arquivo, usar o prompt padrão
+        logger.warning(f"Arquivo de prompt não encontrado nos caminhos: {[str(p) for p in PROMPT_CANDIDATOS]}")
+        return PROMPT_PADRAO
+    
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            prompt = f.read().strip()
+            _prompt_source = (path, os.fstat(f.fileno()).st_mtime)
+        logger.info(f"Prompt carregado de: {path}")
+        return prompt
     except Exception as e:
-        logger.error(f"Erro ao carregar prompt: {str(e)}")
+        logger.error(f"Erro ao carregar prompt de {path}: {str(e)}")
         return "Você é um analista financeiro. Analise os documentos fornecidos e forneça um relatório detalhado."
 
 # Parâmetros do modelo
 MODELO = "gpt-4o-mini"
 LIMITE_TOTAL_TOKENS = 128000
-LIMITE_COMPLETION = 16384
-LIMITE_PROMPT = LIMITE_TOTAL_TOKENS - LIMITE_COMPLETION
+LIMITE_COMPLETION = int(os.getenv("OPENAI_MAX_TOKENS", "16384"))
+# Limite de tokens do prompt: por padrão, toda a janela de contexto que sobra para o prompt.
+# MAX_INPUT_TOKENS permite reduzir o limite para controlar o custo por análise.
+LIMITE_PROMPT = min(
+    LIMITE_TOTAL_TOKENS - LIMITE_COMPLETION,
+    int(os.getenv("MAX_INPUT_TOKENS", str(LIMITE_TOTAL_TOKENS - LIMITE_COMPLETION)))
+)
+
+# Partes fixas do prompt. Tudo o que não muda entre requisições fica antes do texto dos
+# documentos (instruções finais no prompt do sistema, introdução no início da mensagem do
+# usuário), para que o prefixo idêntico seja aproveitado pelo cache de prompts da OpenAI.
+PROMPT_FIXO = (
+    "Analise o seguinte conteúdo dos documentos empresariais:\n\n"
+)
+PROMPT_FINAL = (
+    "\n\nForneça uma análise completa seguindo a estrutura solicitada. \n"
+    "Note que pode haver múltiplos documentos para cada categoria "
+    "(ex: múltiplos arquivos de Faturamento Fiscal ou SPC/Serasa). "
+    "Considere todos os documentos em sua análise, mesmo que sejam da mesma categoria."
+)
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """Retorna o tokenizador do modelo, carregado no primeiro uso e reutilizado depois."""
+    return tiktoken.encoding_for_model(MODELO)
+
+def prompt_file_changed() -> bool:
+    """Verifica se o arquivo de prompt carregado foi alterado ou removido desde a leitura."""
+    if _prompt_source is None:
+        return False
+    path, mtime = _prompt_source
+    try:
+        return path.stat().st_mtime != mtime
+    except OSError:
+        return True
+
+# Aviso adicionado ao final do texto dos documentos quando ele é truncado
+AVISO_TRUNCAMENTO = "\n\n[TEXTO TRUNCADO AUTOMATICAMENTE]"
+
+def get_system_prompt() -> str:
+    """Prompt do sistema: prompt do arquivo seguido das instruções finais fixas."""
+    if PROMPT_AUTO_RELOAD and prompt_file_changed():
+        logger.info("Arquivo de prompt alterado, recarregando")
+        load_prompt_from_file.cache_clear()
+    return _juntar_system_prompt(load_prompt_from_file())
+
+@functools.lru_cache(maxsize=1)
+def _juntar_system_prompt(prompt: str) -> str:
+    # Mesmo objeto str a cada requisição: sem copiar o prompt, e com o hash já calculado
+    # para as buscas em cache que usam o prompt como chave
+    return prompt + PROMPT_FINAL
+
+@functools.lru_cache(maxsize=4)
+def count_fixed_prompt_tokens(system_prompt: str) -> int:
+    """Número de tokens da parte fixa do prompt (sistema + introdução do usuário)."""
+    encoding = get_tokenizer()
+    return len(encoding.encode_ordinary(system_prompt)) + len(encoding.encode_ordinary(PROMPT_FIXO))
 
 def extrair_segmento_do_cnae(texto: str) -> str:
     """
@@ -187,126 +494,362 @@ def extrair_segmento_do_cnae(texto: str) -> str:
     logger.warning("Não foi encontrado CNAE principal no texto")
     return "Outro"
 
-async def analyze_with_openai(combined_text: str) -> tuple:
-    """Envia o texto extraído para análise da OpenAI e retorna a análise e o uso de tokens"""
-    if not client:
-        raise HTTPException(
-            status_code=500,
-            detail="Cliente OpenAI não está configurado. Verifique a OPENAI_API_KEY."
-        )
-
-    try:
-        # Carrega o prompt do arquivo
-        system_prompt = load_prompt_from_file()
-
-        # Parte fixa do prompt do usuário
-        prompt_fixo = (
-            "Analise o seguinte conteúdo dos documentos empresariais:\n\n"
-        )
-        prompt_final = (
-            "\n\nForneça uma análise completa seguindo a estrutura solicitada. \n"
-            "Note que pode haver múltiplos documentos para cada categoria "
-            "(ex: múltiplos arquivos de Faturamento Fiscal ou SPC/Serasa). "
-            "Considere todos os documentos em sua análise, mesmo que sejam da mesma categoria."
-        )
-
-        # Inicializa o tokenizador
-        encoding = tiktoken.encoding_for_model(MODELO)
+def build_analysis_messages(combined_text: str) -> list:
+    """Monta as mensagens da análise, truncando o texto dos documentos ao limite de tokens do prompt"""
+    # Prompt do sistema (arquivo + instruções finais), idêntico em todas as requisições
+    system_prompt = get_system_prompt()
 
-        # Calcula tokens fixos (system + prompt + instruções)
-        system_tokens = len(encoding.encode(system_prompt))
-        fixed_tokens = len(encoding.encode(prompt_fixo + prompt_final))
+    # Tokenizador do modelo (carregado uma única vez por processo)
+    encoding = get_tokenizer()
 
-        # Quanto sobra para os documentos
-        tokens_disponiveis_para_docs = LIMITE_PROMPT - system_tokens - fixed_tokens
+    # Quanto sobra para os documentos depois dos tokens fixos (sistema + introdução)
+    tokens_disponiveis_para_docs = LIMITE_PROMPT - count_fixed_prompt_tokens(system_prompt)
 
-        # Codifica o texto dos documentos
-        doc_tokens = encoding.encode(combined_text)
+    # Cada token corresponde a pelo menos um byte: textos com até esse número de bytes em
+    # UTF-8 (no máximo 4 por caractere) cabem no limite sem precisar ser tokenizados
+    if len(combined_text) * 4 > tokens_disponiveis_para_docs and \
+            len(combined_text.encode('utf-8')) > tokens_disponiveis_para_docs:
+        # Codifica o texto dos documentos (sem tratar tokens especiais: o texto vem dos
+        # arquivos enviados e sequências como "<|endoftext|>" são apenas texto)
+        doc_tokens = encoding.encode_ordinary(combined_text)
+        logger.info(f"Texto dos documentos: {len(doc_tokens)} tokens (limite: {tokens_disponiveis_para_docs})")
 
         if len(doc_tokens) > tokens_disponiveis_para_docs:
+            # Reservar os tokens do aviso de truncamento para não ultrapassar o limite
+            limite = tokens_disponiveis_para_docs - len(encoding.encode_ordinary(AVISO_TRUNCAMENTO))
             logger.warning(
                 f"Texto muito grande ({len(doc_tokens)} tokens). "
-                f"Truncando para {tokens_disponiveis_para_docs} tokens."
+                f"Truncando para {limite} tokens."
             )
-            doc_tokens = doc_tokens[:tokens_disponiveis_para_docs]
-            combined_text = encoding.decode(doc_tokens)
-            combined_text += "\n\n[TEXTO TRUNCADO AUTOMATICAMENTE]"
+            combined_text = encoding.decode(doc_tokens[:limite]) + AVISO_TRUNCAMENTO
+    else:
+        logger.info(
+            f"Texto dos documentos: {len(combined_text)} caracteres, "
+            f"dentro do limite de {tokens_disponiveis_para_docs} tokens sem tokenizar"
+        )
 
-        # Monta o prompt final
-        user_prompt = f"{prompt_fixo}{combined_text}{prompt_final}"
-        
-        # Imprime o texto combinado final após todas as transformações
-        print("\n===== TEXTO COMBINADO FINAL APÓS TRANSFORMAÇÕES =====")
-        print(f"Tamanho total: {len(combined_text)} caracteres")
-        print("Primeiros 500 caracteres:")
-        print(combined_text[:500] + "..." if len(combined_text) > 500 else combined_text)
-        print("Últimos 500 caracteres:")
-        print("..." + combined_text[-500:] if len(combined_text) > 500 else combined_text)
-        print("============================================\n")
-        
-        # Imprime o prompt do sistema e uma parte do prompt do usuário para visualização
-        print("\n===== PROMPT DO SISTEMA =====")
-        print(system_prompt[:500] + "..." if len(system_prompt) > 500 else system_prompt)
-        print("\n===== PARTE DO PROMPT DO USUÁRIO =====")
-        print(user_prompt[:500] + "...")  # Mostrar apenas os primeiros 500 caracteres
-        print("=================================\n")
+    # Monta o prompt do usuário: a introdução fixa vem antes do texto variável
+    user_prompt = f"{PROMPT_FIXO}{combined_text}"
+    
+    # Imprime o texto combinado final após todas as transformações
+    print("\n===== TEXTO COMBINADO FINAL APÓS TRANSFORMAÇÕES =====")
+    print(f"Tamanho total: {len(combined_text)} caracteres")
+    print("Primeiros 500 caracteres:")
+    print(combined_text[:500] + "..." if len(combined_text) > 500 else combined_text)
+    print("Últimos 500 caracteres:")
+    print("..." + combined_text[-500:] if len(combined_text) > 500 else combined_text)
+    print("============================================\n")
+    
+    # Imprime o prompt do sistema e uma parte do prompt do usuário para visualização
+    print("\n===== PROMPT DO SISTEMA =====")
+    print(system_prompt[:500] + "..." if len(system_prompt) > 500 else system_prompt)
+    print("\n===== PARTE DO PROMPT DO USUÁRIO =====")
+    print(user_prompt[:500] + "...")  # Mostrar apenas os primeiros 500 caracteres
+    print("=================================\n")
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def analysis_cache_key(messages: list) -> str:
+    """
+    Chave do cache de análises: modelo + prompts completos, exatamente como enviados
+    (alterar o prompt, os documentos ou o planejamento invalida o cache). Os espaços não
+    são normalizados: em tabelas e extratos, quebras de linha e colunas fazem parte do dado.
+    """
+    return content_hash("\0".join([MODELO] + [message["content"] for message in messages]))
+
+# Marcadores usados para verificar se a resposta da análise está em markdown
+MARKDOWN_INDICATORS = (
+    "# ", "## ", "### ", "#### ", "##### ", "- ", "* ", "1. ", "> ", "```", "---",
+    "**", "_", "[", "](", "|", "+-"
+)
+
+def _campo(obj, nome):
+    # Campos de respostas da OpenAI que o SDK pode expor como atributo ou como dict (campos extras)
+    if isinstance(obj, dict):
+        return obj.get(nome)
+    return getattr(obj, nome, None)
 
-        logger.info("Enviando texto para análise da OpenAI...")
+def montar_token_usage(usage) -> dict:
+    """
+    Uso de tokens informado pela OpenAI. cached_tokens são os tokens do prompt
+    atendidos pelo cache de prompts da OpenAI (0 se não informado).
+    """
+    details = _campo(usage, "prompt_tokens_details")
+    return {
+        "prompt_tokens": _campo(usage, "prompt_tokens"),
+        "completion_tokens": _campo(usage, "completion_tokens"),
+        "total_tokens": _campo(usage, "total_tokens"),
+        "cached_tokens": (_campo(details, "cached_tokens") if details else None) or 0
+    }
+
+def registrar_uso_de_tokens(token_usage: dict, origem: str = ""):
+    """Registra o uso de tokens da análise e quanto do prompt foi atendido pelo cache da OpenAI"""
+    logger.info(f"Análise concluída{origem}. Tokens utilizados: {token_usage}")
+    prompt_tokens = token_usage.get("prompt_tokens") or 0
+    if prompt_tokens:
+        logger.info(
+            f"Cache de prompts da OpenAI: {token_usage['cached_tokens']} de {prompt_tokens} tokens "
+            f"do prompt ({100 * token_usage['cached_tokens'] / prompt_tokens:.0f}%)"
+        )
 
-        # Envia para a API
-        response = client.chat.completions.create(
+async def stream_openai(messages: list):
+    """
+    Envia as mensagens para a OpenAI em modo stream e gera tuplas (trecho, uso de tokens,
+    finish_reason) à medida que os chunks chegam. O uso de tokens vem apenas no último
+    chunk; finish_reason, no chunk que encerra a resposta.
+    """
+    # O stream ocupa uma vaga de chamada à OpenAI até terminar
+    async with get_openai_semaphore():
+        stream = await client.chat.completions.create(
             model=MODELO,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=messages,
             max_tokens=LIMITE_COMPLETION,
-            temperature=0.4
+            temperature=0.4,
+            stream=True,
+            # O último chunk traz o uso de tokens (opção enviada no corpo da requisição)
+            extra_body={"stream_options": {"include_usage": True}}
+        )
+        async for chunk in stream:
+            choice = chunk.choices[0] if chunk.choices else None
+            delta = choice.delta.content if choice else None
+            finish_reason = choice.finish_reason if choice else None
+            yield delta, _campo(chunk, "usage"), finish_reason
+
+def resposta_truncada(finish_reason) -> bool:
+    """Indica se a resposta foi cortada pelo limite de tokens (e não deve ir para o cache)"""
+    if finish_reason == "length":
+        logger.warning(
+            f"Análise interrompida pelo limite de {LIMITE_COMPLETION} tokens da resposta "
+            "(OPENAI_MAX_TOKENS); o resultado não será armazenado em cache"
         )
+        return True
+    return False
+
+async def _request_analysis(messages: list) -> tuple:
+    """Chama a API da OpenAI e retorna a análise, o uso de tokens e se a análise foi truncada"""
+    logger.info("Enviando texto para análise da OpenAI...")
+
+    # Recebe a resposta em stream, juntando os trechos à medida que chegam
+    partes = []
+    usage = None
+    finish_reason = None
+    async for delta, chunk_usage, chunk_finish_reason in stream_openai(messages):
+        if delta:
+            partes.append(delta)
+        if chunk_usage:
+            usage = chunk_usage
+        if chunk_finish_reason:
+            finish_reason = chunk_finish_reason
+
+    # Extrai resultado
+    analysis = "".join(partes)
+    token_usage = montar_token_usage(usage)
+
+    registrar_uso_de_tokens(token_usage)
+    
+    # Verificar se a resposta está em formato markdown e destacar isso
+    print("\n===== VERIFICAÇÃO DE FORMATO MARKDOWN NA RESPOSTA =====")
+    has_markdown = any(indicator in analysis for indicator in MARKDOWN_INDICATORS)
+    print(f"A resposta contém formatação markdown: {'Sim' if has_markdown else 'Não'}")
+    
+    if has_markdown:
+        print("\n===== ELEMENTOS MARKDOWN DETECTADOS =====")
+        for indicator in MARKDOWN_INDICATORS:
+            if indicator in analysis:
+                print(f"- {indicator}")
+    
+    # Mostrar parte da análise recebida
+    print("\n===== PARTE DA ANÁLISE RECEBIDA =====")
+    print(analysis[:1000] + "..." if len(analysis) > 1000 else analysis)
+    print("====================================\n")
 
-        # Extrai resultado
-        analysis = response.choices[0].message.content
-        token_usage = {
-            "prompt_tokens": response.usage.prompt_tokens,
-            "completion_tokens": response.usage.completion_tokens,
-            "total_tokens": response.usage.total_tokens
-        }
+    return analysis, token_usage, resposta_truncada(finish_reason)
 
-        logger.info(f"Análise concluída. Tokens utilizados: {token_usage}")
-        
-        # Verificar se a resposta está em formato markdown e destacar isso
-        print("\n===== VERIFICAÇÃO DE FORMATO MARKDOWN NA RESPOSTA =====")
-        markdown_indicators = [
-            "# ", "## ", "### ", "#### ", "##### ", "- ", "* ", "1. ", "> ", "```", "---",
-            "**", "_", "[", "](", "|", "+-"
-        ]
-        has_markdown = any(indicator in analysis for indicator in markdown_indicators)
-        print(f"A resposta contém formatação markdown: {'Sim' if has_markdown else 'Não'}")
-        
-        if has_markdown:
-            print("\n===== ELEMENTOS MARKDOWN DETECTADOS =====")
-            for indicator in markdown_indicators:
-                if indicator in analysis:
-                    print(f"- {indicator}")
-        
-        # Mostrar parte da análise recebida
-        print("\n===== PARTE DA ANÁLISE RECEBIDA =====")
-        print(analysis[:1000] + "..." if len(analysis) > 1000 else analysis)
-        print("====================================\n")
+async def analyze_with_openai(combined_text: str) -> tuple:
+    """
+    Envia o texto extraído para análise da OpenAI e retorna a análise, o uso de tokens
+    e se o resultado veio do cache de análises
+    """
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Cliente OpenAI não está configurado. Verifique a OPENAI_API_KEY."
+        )
 
-        return analysis, token_usage
+    try:
+        messages = build_analysis_messages(combined_text)
+        
+        # Reenvio do mesmo conjunto de documentos: reaproveitar a análise anterior
+        cache_key = analysis_cache_key(messages)
+        cached = _analysis_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Análise obtida do cache, sem chamada à OpenAI")
+            analysis, token_usage = cached
+            return analysis, token_usage, True
+
+        # Análise idêntica já em andamento: aguardar o mesmo resultado em vez de repetir a chamada
+        inflight = _analysis_inflight.get(cache_key)
+        if inflight is not None:
+            logger.info("Análise idêntica em andamento, aguardando o resultado")
+            analysis, token_usage, _ = await asyncio.shield(inflight)
+            return analysis, token_usage, True
+
+        # A chamada roda em uma task compartilhada, que segue mesmo se este cliente desconectar
+        task = asyncio.ensure_future(_request_analysis(messages))
+        _analysis_inflight[cache_key] = task
+        task.add_done_callback(lambda _: _analysis_inflight.pop(cache_key, None))
+        analysis, token_usage, truncada = await asyncio.shield(task)
+
+        if not truncada:
+            _analysis_cache.set(cache_key, (analysis, token_usage))
+        return analysis, token_usage, False
 
     except Exception as e:
         logger.error(f"Erro ao chamar OpenAI: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao processar análise: {str(e)}")
 
-@app.post("/analyze/")
-async def analyze(
-    files: List[UploadFile] = File(...),
-    document_types: Optional[str] = Form(None),
-    planning_data: Optional[str] = Form(None),
-    user_id: Optional[str] = Form(None)
-):
+# Linhas do bloco de planejamento no texto da análise:
+# (campo, campo usado quando o valor é "Outro", modelo da linha)
+LINHAS_PLANEJAMENTO = (
+    ("objective", "otherObjective", "Objetivo do Crédito: {}\n"),
+    ("creditAmount", None, "Valor do Crédito Buscado: R$ {}\n"),
+    ("timeInCompany", None, "Tempo na Empresa: {} anos\n"),
+    ("gracePeriod", None, "Carência Solicitada: {} meses\n"),
+)
+
+def renderizar_planejamento(planning_json: dict):
+    """Gera os trechos do bloco de dados de planejamento, começando pelo cabeçalho"""
+    yield "=== DADOS DE PLANEJAMENTO ===\n"
+    
+    for campo, campo_outro, modelo in LINHAS_PLANEJAMENTO:
+        valor = planning_json.get(campo)
+        if not valor:
+            continue
+        if valor == "Outro" and campo_outro and planning_json.get(campo_outro):
+            valor = planning_json[campo_outro]
+        yield modelo.format(valor)
+    
+    # Garantias
+    garantias = planning_json.get("collaterals")
+    if garantias and isinstance(garantias, list):
+        yield "Garantias:\n"
+        for idx, collateral in enumerate(garantias, 1):
+            if isinstance(collateral, dict):
+                yield f"  - Garantia {idx}: {collateral.get('type', 'Não especificado')}, Valor: R$ {collateral.get('value', 0)}\n"
+    
+    yield "\n\n"
+
+# Categoria usada no texto da análise para cada tipo de documento informado pelo cliente
+CATEGORIAS_ANALISE = {
+    "cnpj": "Cartão CNPJ",
+    "registrato": "Registro",
+    "scr": "Registro",
+    "imposto": "Imposto de Renda",
+    "irpf": "Imposto de Renda",
+    "fiscal": "Situação Fiscal",
+    "faturamento_gerencial": "Faturamento Gerencial",
+    "faturamento": "Faturamento Fiscal",
+    "faturamento_fiscal": "Faturamento Fiscal",
+    "spc": "SPC e Serasa",
+    "serasa": "SPC e Serasa",
+    "demonstrativo": "Demonstrativo",
+    "extrato": "Demonstrativo",
+}
+
+# Tipos de documento processados como registrato (SCR) após a extração dos demais
+TIPOS_REGISTRATO = frozenset({"registrato", "scr"})
+
+# Categoria interna dos arquivos de um relatório salvo, por tipo de documento
+CATEGORIAS_RELATORIO = {
+    "imposto": "incomeTax",
+    "irpf": "incomeTax",
+    "registro": "registration",
+    "registrato": "registration",
+    "scr": "registration",
+    "contrato": "registration",
+    "fiscal": "taxStatus",
+    "faturamento_gerencial": "managementBilling",
+    "faturamento": "taxBilling",
+    "faturamento_fiscal": "taxBilling",
+    "spc": "spcSerasa",
+    "serasa": "spcSerasa",
+    "demonstrativo": "statement",
+    "extrato": "statement",
+    "cnpj": "cnpj",
+}
+
+# Placeholder dos registratos até o processamento estruturado do SCR
+REGISTRATO_PENDENTE = "[REGISTRATO - SERÁ PROCESSADO COM CAMELOT]\n\n"
+
+def tamanho_upload(file: UploadFile) -> int:
+    """Tamanho do arquivo enviado em bytes, sem ler o seu conteúdo"""
+    if file.size is not None:
+        return file.size
+    posicao = file.file.tell()
+    file.file.seek(0, os.SEEK_END)
+    tamanho = file.file.tell()
+    file.file.seek(posicao)
+    return tamanho
+
+def cabecalho_upload(file: UploadFile) -> bytes:
+    """Bytes iniciais do arquivo enviado, lidos sem alterar a posição de leitura"""
+    posicao = file.file.tell()
+    file.file.seek(0)
+    cabecalho = file.file.read(TAMANHO_CABECALHO)
+    file.file.seek(posicao)
+    return cabecalho
+
+def validar_arquivos(files: List[UploadFile]):
+    """
+    Verifica o tipo e o tamanho de todos os arquivos enviados, rejeitando a requisição
+    inteira antes de qualquer leitura ou extração.
+    """
+    total = 0
+    for file in files:
+        if file.content_type not in SUPPORTED_CONTENT_TYPES:
+            logger.error(f"Tipo de arquivo não suportado: {file.content_type}")
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Arquivo {file.filename} não é suportado. Formatos aceitos: PDF, JPEG, PNG, DOC, DOCX."
+            )
+        
+        # O content_type vem do cliente: conferir com os bytes iniciais do arquivo para
+        # rejeitar arquivos corrompidos ou com tipo falso antes de enviá-los à extração
+        tipo_detectado = detectar_tipo_conteudo(cabecalho_upload(file))
+        if tipo_detectado is None or not mesmo_extrator(tipo_detectado, file.content_type):
+            logger.error(f"Conteúdo de {file.filename} não corresponde ao tipo {file.content_type} (detectado: {tipo_detectado})")
+            raise HTTPException(
+                status_code=400,
+                detail=f"O conteúdo do arquivo {file.filename} não corresponde ao tipo informado ({file.content_type})."
+            )
+        
+        tamanho = tamanho_upload(file)
+        if tamanho > MAX_FILE_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Arquivo {file.filename} excede o limite de {MAX_FILE_BYTES // (1024 * 1024)} MB."
+            )
+        total += tamanho
+    
+    if total > MAX_TOTAL_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Os arquivos enviados excedem o limite total de {MAX_TOTAL_BYTES // (1024 * 1024)} MB."
+        )
+
+async def preparar_analise(files: List[UploadFile], document_types: Optional[str],
+                           planning_data: Optional[str], user_id: Optional[str]) -> tuple:
+    """
+    Primeira etapa da análise: valida os arquivos, consome o relatório do plano do usuário
+    e extrai o texto dos documentos.
+    
+    Returns:
+        tuple: (texto combinado, arquivos processados, número de arquivos com texto extraído,
+                segmento detectado)
+    """
     # Importar helper de log
     try:
         from app.log_helper import log_document_types
@@ -317,10 +860,14 @@ async def analyze(
     
     if not files:
         raise HTTPException(status_code=400, detail="Nenhum arquivo enviado.")
+    
+    # Validar todos os arquivos antes de consumir o relatório ou iniciar qualquer extração
+    validar_arquivos(files)
 
     # Verificar se o usuário tem relatórios disponíveis
     if user_id and stripe_available:
-        resultado = consumir_relatorio(user_id)
+        resultado = await executar_em_thread(consumir_relatorio, user_id)
+        _plan_cache.pop(user_id)
         if not resultado.get("success"):
             raise HTTPException(
                 status_code=402, 
@@ -328,53 +875,24 @@ async def analyze(
             )
         logger.info(f"Usuário {user_id} tem {resultado.get('reports_left')} relatórios restantes")
     
-    combined_text = ""
-    processed_files = []
+    parts = []  # Trechos do texto combinado, unidos uma única vez após a extração
+    document_parts = [()] * len(files)  # Trechos de cada arquivo, na ordem de envio
+    processed_files = [None] * len(files)
     registrato_files = []  # Armazenar os arquivos Registrato para processamento posterior
-    cartao_cnpj_text = ""
+    cartao_cnpj_textos = []
+    documentos_pendentes = []  # (índice, arquivo, categoria) dos documentos com extração de texto
+    arquivos_processados = 0  # Arquivos com texto extraído com sucesso
     
     # Processar dados de planejamento, se fornecidos
     if planning_data:
         try:
-            planning_json = json.loads(planning_data)
+            planning_json = json_helper.loads(planning_data)
             logger.info(f"Dados de planejamento recebidos: {planning_json}")
             print("\n===== DADOS DE PLANEJAMENTO RECEBIDOS =====")
             print(json.dumps(planning_json, indent=2, ensure_ascii=False))
             print("===========================================\n")
             
-            combined_text += "=== DADOS DE PLANEJAMENTO ===\n"
-            
-            # Remover recepção do segmento - será extraído do cartão CNPJ
-            
-            # Adicionar objetivo
-            if planning_json.get("objective"):
-                objective = planning_json["objective"]
-                if objective == "Outro" and planning_json.get("otherObjective"):
-                    objective = planning_json["otherObjective"]
-                combined_text += f"Objetivo do Crédito: {objective}\n"
-            
-            # Adicionar valor do crédito
-            if planning_json.get("creditAmount"):
-                combined_text += f"Valor do Crédito Buscado: R$ {planning_json['creditAmount']}\n"
-            
-            # Adicionar tempo na empresa
-            if planning_json.get("timeInCompany"):
-                combined_text += f"Tempo na Empresa: {planning_json['timeInCompany']} anos\n"
-                
-            # Adicionar carência solicitada
-            if planning_json.get("gracePeriod"):
-                combined_text += f"Carência Solicitada: {planning_json['gracePeriod']} meses\n"
-            
-            # Adicionar garantias
-            if planning_json.get("collaterals") and isinstance(planning_json["collaterals"], list):
-                combined_text += "Garantias:\n"
-                for idx, collateral in enumerate(planning_json["collaterals"]):
-                    if isinstance(collateral, dict):
-                        tipo = collateral.get("type", "Não especificado")
-                        valor = collateral.get("value", 0)
-                        combined_text += f"  - Garantia {idx+1}: {tipo}, Valor: R$ {valor}\n"
-                
-            combined_text += "\n\n"
+            parts.extend(renderizar_planejamento(planning_json))
         except json.JSONDecodeError as e:
             logger.error(f"Erro ao decodificar dados de planejamento: {str(e)}")
             # Continuar mesmo com erro nos dados de planejamento
@@ -387,7 +905,7 @@ async def analyze(
     document_type_map = {}
     if document_types:
         try:
-            doc_types = json.loads(document_types)
+            doc_types = json_helper.loads(document_types)
             # Formato esperado: {"file_index": "document_type"}
             # Onde file_index é o índice do arquivo (string) e document_type é o tipo do documento
             if isinstance(doc_types, dict):
@@ -414,19 +932,6 @@ async def analyze(
         logger.info(f"Processando arquivo {i+1}: {file.filename}, tipo: {file.content_type}")
         print(f"\nProcessando arquivo {i+1}/{len(files)}: {file.filename} ({file.content_type})")
         
-        # Verificar se o tipo de arquivo é suportado
-        content_type = file.content_type
-        supported_types = ["application/pdf", "image/jpeg", "image/png", 
-                          "application/msword", 
-                          "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]
-        
-        if content_type not in supported_types:
-            logger.error(f"Tipo de arquivo não suportado: {content_type}")
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Arquivo {file.filename} não é suportado. Formatos aceitos: PDF, JPEG, PNG, DOC, DOCX."
-            )
-            
         # Identificar categoria do arquivo para uma melhor organização no texto
         category = None
         
@@ -446,12 +951,15 @@ async def analyze(
             
         if str_index in document_type_map:
             doc_type = document_type_map[str_index]
-            if doc_type == "cnpj":
-                category = 'Cartão CNPJ'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "registrato" or doc_type == "scr":
-                category = 'Registro'
+            category = CATEGORIAS_ANALISE.get(doc_type)
+            if category is not None:
                 print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
+            else:
+                # Usar o tipo fornecido como está
+                category = doc_type.capitalize()
+                print(f"  -> Categoria identificada: {category} (tipo informado pelo cliente)")
+            
+            if doc_type in TIPOS_REGISTRATO:
                 print(f"  -> REGISTRATO/SCR ENCONTRADO: {file.filename}")
                 logger.info(f"Registrato/SCR identificado: {file.filename}. Será processado com DocLing posteriormente.")
                 
@@ -463,82 +971,84 @@ async def analyze(
                 })
                 
                 # Adicionar um placeholder temporário
-                combined_text += f"\n=== DOCUMENTO ({category}): {file.filename} ===\n"
-                combined_text += f"[REGISTRATO - SERÁ PROCESSADO COM CAMELOT]\n\n"
+                document_parts[i] = (
+                    f"\n=== DOCUMENTO ({category}): {file.filename} ===\n",
+                    REGISTRATO_PENDENTE,
+                )
                 
-                processed_files.append({
+                processed_files[i] = {
                     "filename": file.filename,
                     "status": "para_processamento",
                     "category": category
-                })
+                }
                 continue  # Pular para o próximo arquivo, pois este já foi tratado
-            elif doc_type == "imposto" or doc_type == "irpf":
-                category = 'Imposto de Renda'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "fiscal":
-                category = 'Situação Fiscal'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "faturamento_gerencial":
-                category = 'Faturamento Gerencial'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "faturamento" or doc_type == "faturamento_fiscal":
-                category = 'Faturamento Fiscal'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "spc" or doc_type == "serasa":
-                category = 'SPC e Serasa'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            elif doc_type == "demonstrativo" or doc_type == "extrato":
-                category = 'Demonstrativo'
-                print(f"  -> Categoria identificada: {category} (informada pelo cliente)")
-            else:
-                # Usar o tipo fornecido como está
-                category = doc_type.capitalize()
-                print(f"  -> Categoria identificada: {category} (tipo informado pelo cliente)")
         else:
             # Se não houver tipo especificado, usar uma categoria genérica
             category = 'Documento Adicional'
             print(f"  -> Categoria identificada: {category} (tipo não especificado)")
         
         # Se chegou aqui, processar normalmente (não é um arquivo de Registrato já tratado)
-        try:
-            logger.info(f"Iniciando extração de texto para {file.filename}")
-            text = await extract_text_from_document(file)
-            
-            if not text or not text.strip():
-                logger.warning(f"Arquivo {file.filename} está vazio ou não pôde ser lido.")
-                processed_files.append({
-                    "filename": file.filename,
-                    "status": "vazio",
-                    "text_length": 0
-                })
-                continue
-            
-            # Se for um cartão CNPJ, armazenar o texto para extração de segmento
-            if category == 'Cartão CNPJ':
-                cartao_cnpj_text += text
-            
-            combined_text += f"\n=== DOCUMENTO ({category}): {file.filename} ===\n"
-            combined_text += text + "\n\n"
-            
-            processed_files.append({
-                "filename": file.filename,
-                "status": "processado",
-                "text_length": len(text),
-                "category": category
-            })
-            
-            logger.info(f"Arquivo {file.filename} processado com sucesso. Texto extraído: {len(text)} caracteres")
-            print(f"Arquivo processado com sucesso. Categoria identificada: {category}")
-            print(f"Total de caracteres extraídos: {len(text)}")
-            
-        except Exception as e:
-            logger.error(f"Erro ao processar {file.filename}: {str(e)}")
+        documentos_pendentes.append((i, file, category))
+    
+    # Extrair o texto dos arquivos em paralelo: a extração (PDF/OCR/Word, limitada por CPU)
+    # é distribuída no pool de processos. O semáforo limita quantos arquivos desta requisição
+    # ocupam o pool ao mesmo tempo, para que um envio com muitos arquivos não atrase as
+    # extrações das demais requisições.
+    limite_extracao = asyncio.Semaphore(max(1, min(EXTRACTION_PARALLELISM, len(documentos_pendentes))))
+    
+    async def extrair_com_limite(file):
+        async with limite_extracao:
+            # O upload continua no arquivo temporário do Starlette (em disco quando grande)
+            # até a sua vez: só os arquivos em extração ficam com o conteúdo em memória
+            content = await file.read()
+            return await extrair_texto(content, file.content_type, file.filename)
+    
+    results = await asyncio.gather(
+        *(extrair_com_limite(file) for _, file, _ in documentos_pendentes),
+        return_exceptions=True
+    )
+    
+    for (i, file, category), text in zip(documentos_pendentes, results):
+        if isinstance(text, Exception):
+            logger.error(f"Erro ao processar {file.filename}: {str(text)}")
             raise HTTPException(
                 status_code=400, 
-                detail=f"Erro ao processar {file.filename}: {str(e)}"
+                detail=f"Erro ao processar {file.filename}: {str(text)}"
             )
+        
+        if not text or not text.strip():
+            logger.warning(f"Arquivo {file.filename} está vazio ou não pôde ser lido.")
+            processed_files[i] = {
+                "filename": file.filename,
+                "status": "vazio",
+                "text_length": 0
+            }
+            continue
+        
+        # Se for um cartão CNPJ, armazenar o texto para extração de segmento
+        if category == 'Cartão CNPJ':
+            cartao_cnpj_textos.append(text)
+        
+        document_parts[i] = (f"\n=== DOCUMENTO ({category}): {file.filename} ===\n", text, "\n\n")
+        
+        processed_files[i] = {
+            "filename": file.filename,
+            "status": "processado",
+            "text_length": len(text),
+            "category": category
+        }
+        arquivos_processados += 1
+        
+        logger.info(f"Arquivo {file.filename} processado com sucesso. Texto extraído: {len(text)} caracteres")
+        print(f"Arquivo processado com sucesso. Categoria identificada: {category}")
+        print(f"Total de caracteres extraídos: {len(text)}")
+    
+    # Trechos do texto combinado na ordem de envio dos arquivos. O texto é montado de uma só
+    # vez no final, depois que os registratos preenchem as suas posições em document_parts.
+    def trechos():
+        return itertools.chain(parts, itertools.chain.from_iterable(document_parts))
     
-    if not combined_text.strip():
+    if not any(trecho.strip() for trecho in trechos()):
         raise HTTPException(
             status_code=400,
             detail="Nenhum texto foi extraído dos arquivos enviados."
@@ -546,22 +1056,24 @@ async def analyze(
     
     # Extrair o segmento a partir do texto do cartão CNPJ
     segment = "Outro"
-    if cartao_cnpj_text:
+    if cartao_cnpj_textos:
+        cartao_cnpj_text = "".join(cartao_cnpj_textos)
         segment = extrair_segmento_do_cnae(cartao_cnpj_text)
         logger.info(f"Segmento extraído do CNAE: {segment}")
         print(f"\n===== SEGMENTO EXTRAÍDO DO CNAE: {segment} =====")
         
         # Adicionar o segmento identificado aos dados de planejamento para o contexto da análise
-        combined_text = combined_text.replace("=== DADOS DE PLANEJAMENTO ===\n", 
-                                             f"=== DADOS DE PLANEJAMENTO ===\nSegmento da Empresa: {segment}\n")
+        if parts:
+            parts.insert(1, f"Segmento da Empresa: {segment}\n")
     else:
         logger.warning("Cartão CNPJ não encontrado. Segmento não pôde ser extraído.")
         print("\n===== CARTÃO CNPJ NÃO ENCONTRADO. SEGMENTO NÃO EXTRAÍDO =====")
     
-    logger.info(f"Extração concluída. Total de texto: {len(combined_text)} caracteres")
+    total_caracteres = sum(len(trecho) for trecho in trechos())
+    logger.info(f"Extração concluída. Total de texto: {total_caracteres} caracteres")
     print(f"\n===== EXTRAÇÃO CONCLUÍDA =====")
-    print(f"Total de texto combinado: {len(combined_text)} caracteres")
-    print(f"Total de arquivos processados: {len([f for f in processed_files if f['status'] == 'processado'])}")
+    print(f"Total de texto combinado: {total_caracteres} caracteres")
+    print(f"Total de arquivos processados: {arquivos_processados}")
     print(f"Total de registratos para processar: {len(registrato_files)}")
     print("===============================\n")
     
@@ -598,7 +1110,8 @@ async def analyze(
                     from app.utils import extract_scr_data_from_pdf
                     
                     print(f"Tentando processamento estruturado de SCR para: {filename}")
-                    scr_data = extract_scr_data_from_pdf(file_content, filename)
+                    # A leitura das tabelas com camelot é limitada por CPU: executar no pool de processos
+                    scr_data = await executar_no_pool(extract_scr_data_from_pdf, file_content, filename)
                     
                     # Formatar os dados para markdown estruturado
                     processed_text = f"## Dados SCR: {filename}\n\n"
@@ -646,10 +1159,10 @@ async def analyze(
                     "markdown": processed_text
                 })
                 
-                # Substituir o placeholder pelo texto processado no texto combinado
-                placeholder = f"\n=== DOCUMENTO (Registro): {filename} ===\n[REGISTRATO - SERÁ PROCESSADO COM CAMELOT]\n\n"
-                replacement = f"\n=== DOCUMENTO (Registro): {filename} ===\n{processed_text}\n\n"
-                combined_text = combined_text.replace(placeholder, replacement)
+                # Substituir o placeholder pelo texto processado, na posição do arquivo
+                document_parts[registrato["index"] - 1] = (
+                    f"\n=== DOCUMENTO (Registro): {filename} ===\n", processed_text, "\n\n"
+                )
                 
                 print(f"✅ Registrato processado: {filename}")
                 
@@ -657,10 +1170,10 @@ async def analyze(
                 print(f"⚠️ Erro ao processar registrato {filename}: {str(e)}")
                 logger.error(f"Erro ao processar registrato {filename}: {str(e)}")
                 
-                # Adicionar mensagem de erro ao texto combinado
-                placeholder = f"\n=== DOCUMENTO (Registro): {filename} ===\n[REGISTRATO - SERÁ PROCESSADO COM CAMELOT]\n\n"
-                replacement = f"\n=== DOCUMENTO (Registro): {filename} ===\n[ERRO AO PROCESSAR REGISTRATO: {str(e)}]\n\n"
-                combined_text = combined_text.replace(placeholder, replacement)
+                # Adicionar mensagem de erro no lugar do placeholder
+                document_parts[registrato["index"] - 1] = (
+                    f"\n=== DOCUMENTO (Registro): {filename} ===\n", f"[ERRO AO PROCESSAR REGISTRATO: {str(e)}]", "\n\n"
+                )
         
         print(f"\nTotal de {len(registratos_processados)} registratos processados")
         
@@ -681,23 +1194,48 @@ async def analyze(
         print(f"⚠️ Erro no processamento de registratos: {str(e)}")
         logger.error(f"Erro no processamento de registratos: {str(e)}")
         
-        # Adicionar mensagem de erro para todos os registratos
+        # Adicionar mensagem de erro para os registratos ainda não processados
         for registrato in registrato_files:
-            filename = registrato["filename"]
-            placeholder = f"\n=== DOCUMENTO (Registro): {filename} ===\n[REGISTRATO - SERÁ PROCESSADO COM CAMELOT]\n\n"
-            replacement = f"\n=== DOCUMENTO (Registro): {filename} ===\n[ERRO: {str(e)}]\n\n"
-            combined_text = combined_text.replace(placeholder, replacement)
+            idx = registrato["index"] - 1
+            if document_parts[idx][1] == REGISTRATO_PENDENTE:
+                document_parts[idx] = (
+                    f"\n=== DOCUMENTO (Registro): {registrato['filename']} ===\n", f"[ERRO: {str(e)}]", "\n\n"
+                )
+    
+    # Montar o texto combinado de uma só vez, mantendo a ordem de envio dos arquivos
+    combined_text = "".join(trechos())
     
     # Atualizar os dados de planejamento para incluir o segmento extraído
     if planning_data:
         try:
-            planning_json = json.loads(planning_data)
+            planning_json = json_helper.loads(planning_data)
             planning_json["segment"] = segment
-            planning_data = json.dumps(planning_json)
+            planning_data = json_helper.dumps(planning_json)
         except json.JSONDecodeError as e:
             logger.error(f"Erro ao atualizar dados de planejamento: {str(e)}")
     else:
-        planning_data = json.dumps({"segment": segment})
+        planning_data = json_helper.dumps({"segment": segment})
+    
+    return combined_text, processed_files, arquivos_processados, segment
+
+def agrupar_por_categoria(processed_files: list) -> dict:
+    """Agrupa os arquivos processados por categoria"""
+    files_by_category = {}
+    for file in processed_files:
+        if "category" in file:
+            files_by_category.setdefault(file["category"], []).append(file)
+    return files_by_category
+
+@app.post("/analyze/")
+async def analyze(
+    files: List[UploadFile] = File(...),
+    document_types: Optional[str] = Form(None),
+    planning_data: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None)
+):
+    combined_text, processed_files, arquivos_processados, segment = await preparar_analise(
+        files, document_types, planning_data, user_id
+    )
     
     # Segunda etapa: Enviar para OpenAI para análise
     try:
@@ -705,7 +1243,7 @@ async def analyze(
         print(f"Modelo utilizado: {MODELO}")
         print(f"Tamanho do texto a ser analisado: {len(combined_text)} caracteres")
         
-        analysis, token_usage = await analyze_with_openai(combined_text)
+        analysis, token_usage, cache_hit = await analyze_with_openai(combined_text)
         
         print("\n===== ANÁLISE CONCLUÍDA =====")
         print(f"Tokens do prompt: {token_usage['prompt_tokens']}")
@@ -714,24 +1252,20 @@ async def analyze(
         print("=============================\n")
         
         # Agrupar arquivos processados por categoria
-        files_by_category = {}
-        for file in processed_files:
-            if "category" in file:
-                category = file["category"]
-                if category not in files_by_category:
-                    files_by_category[category] = []
-                files_by_category[category].append(file)
+        files_by_category = agrupar_por_categoria(processed_files)
         
-        return {
+        # A resposta inclui o texto completo da análise: serializar direto, sem o jsonable_encoder
+        return json_response({
             "success": True,
             "analysis": analysis,
             "processed_files": processed_files,
             "files_by_category": files_by_category,
             "total_text_length": len(combined_text),
-            "files_processed": len([f for f in processed_files if f['status'] == 'processado']),
+            "files_processed": arquivos_processados,
             "token_usage": token_usage,
+            "cached": cache_hit,  # Análise reaproveitada do cache (sem nova chamada à OpenAI)
             "detected_segment": segment  # Retornar o segmento extraído
-        }
+        }, headers={"X-Analysis-Cache": "HIT" if cache_hit else "MISS"})
         
     except HTTPException:
         # Re-raise HTTPExceptions (já tratadas)
@@ -743,26 +1277,143 @@ async def analyze(
             detail=f"Erro interno do servidor: {str(e)}"
         )
 
+def sse_event(data: str, event: Optional[str] = None) -> str:
+    """Formata uma mensagem Server-Sent Events (cada linha do conteúdo vira uma linha data:)"""
+    lines = [f"event: {event}"] if event else []
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+@app.post("/analyze/stream/")
+async def analyze_stream(
+    files: List[UploadFile] = File(...),
+    document_types: Optional[str] = Form(None),
+    planning_data: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None)
+):
+    """
+    Igual a /analyze/, mas envia a análise via Server-Sent Events à medida que é gerada.
+    O primeiro evento (metadata) traz os arquivos processados; os eventos seguintes
+    trazem os trechos da análise em JSON ({"delta": ...}) e o evento final (done)
+    traz o uso de tokens.
+    """
+    if not client:
+        raise HTTPException(
+            status_code=500,
+            detail="Cliente OpenAI não está configurado. Verifique a OPENAI_API_KEY."
+        )
+    
+    combined_text, processed_files, arquivos_processados, segment = await preparar_analise(
+        files, document_types, planning_data, user_id
+    )
+    messages = build_analysis_messages(combined_text)
+    cache_key = analysis_cache_key(messages)
+    cached = _analysis_cache.get(cache_key)
+    
+    async def event_gen():
+        metadata = {
+            "processed_files": processed_files,
+            "files_by_category": agrupar_por_categoria(processed_files),
+            "total_text_length": len(combined_text),
+            "files_processed": arquivos_processados,
+            "cached": cached is not None,
+            "detected_segment": segment
+        }
+        yield sse_event(json_helper.dumps(metadata), event="metadata")
+        
+        # Análise já feita para os mesmos documentos: enviar o resultado em um único evento
+        if cached is not None:
+            logger.info("Análise obtida do cache, sem chamada à OpenAI (streaming)")
+            analysis, token_usage = cached
+            yield sse_event(json_helper.dumps({"delta": analysis}))
+            yield sse_event(json_helper.dumps({"token_usage": token_usage}), event="done")
+            return
+        
+        try:
+            logger.info("Enviando texto para análise da OpenAI (streaming)...")
+            partes = []
+            usage = None
+            finish_reason = None
+            async for delta, chunk_usage, chunk_finish_reason in stream_openai(messages):
+                if delta:
+                    partes.append(delta)
+                    yield sse_event(json_helper.dumps({"delta": delta}))
+                if chunk_usage:
+                    usage = chunk_usage
+                if chunk_finish_reason:
+                    finish_reason = chunk_finish_reason
+            
+            token_usage = montar_token_usage(usage) if usage else None
+            if token_usage:
+                registrar_uso_de_tokens(token_usage, " (streaming)")
+                if not resposta_truncada(finish_reason):
+                    _analysis_cache.set(cache_key, ("".join(partes), token_usage))
+            yield sse_event(json_helper.dumps({"token_usage": token_usage}), event="done")
+        except Exception as e:
+            logger.error(f"Erro ao chamar OpenAI (streaming): {str(e)}")
+            yield sse_event(f"Erro ao processar análise: {str(e)}", event="error")
+    
+    return StreamingResponse(event_gen(), media_type="text/event-stream")
+
+# Token dos endpoints administrativos (cabeçalho X-Admin-Token); sem ele, os endpoints ficam desativados
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def verificar_admin(x_admin_token: Optional[str] = Header(None)):
+    """Dependência dos endpoints administrativos: exige o cabeçalho X-Admin-Token igual a ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Endpoints administrativos desativados (ADMIN_TOKEN não definido)")
+    if not x_admin_token or not secrets.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Token administrativo inválido")
+
+@app.post("/admin/reload-prompt", dependencies=[Depends(verificar_admin)])
+async def reload_prompt():
+    """
+    Descarta o prompt em cache para que a próxima análise leia o arquivo novamente.
+    O recarregamento vale apenas para o processo que recebeu a requisição: com vários
+    workers, use PROMPT_AUTO_RELOAD para que todos percebam a alteração do arquivo.
+    """
+    resolve_prompt_path.cache_clear()
+    load_prompt_from_file.cache_clear()
+    system_prompt = load_prompt_from_file()
+    return {
+        "success": True,
+        "message": "Prompt recarregado",
+        "prompt_length": len(system_prompt)
+    }
+
 @app.get("/health")
 async def health_check():
     """Endpoint para verificar se a API está funcionando"""
+    # A configuração não muda com a aplicação no ar: a resposta é montada no startup
+    return app.state.health
+
+def montar_status_saude() -> dict:
+    """Resposta do /health, calculada uma única vez no startup"""
     api_key_status = "configurada" if os.getenv("OPENAI_API_KEY") else "não configurada"
     
     return {
         "status": "healthy",
         "openai_configured": client is not None,
         "api_key_status": api_key_status,
-        "env_file_path": Path(__file__).parent.parent / ".env",
+        "env_file_path": str(_ROOT_DIR / ".env"),
         "current_working_directory": os.getcwd(),
         "message": "API funcionando corretamente"
     }
 
 # Nova classe para o modelo de dados de relatório
 class ReportData(BaseModel):
-    user_id: str
-    user_name: str
-    planning_data: dict
-    report_content: str
+    user_id: str = Field(..., min_length=1)
+    user_name: str = Field(..., min_length=1)
+    planning_data: Optional[dict] = None
+    report_content: str = Field(..., min_length=1)
+
+def validar_report_data(raw: str) -> ReportData:
+    """
+    Decodifica e valida o JSON de report_data em uma única passada (pydantic-core na v2).
+    Com a pydantic v1, usa parse_raw.
+    """
+    if hasattr(ReportData, "model_validate_json"):
+        return ReportData.model_validate_json(raw)
+    return ReportData.parse_raw(raw)
     
 @app.post("/save_report/")
 async def save_report_endpoint(
@@ -784,35 +1435,28 @@ async def save_report_endpoint(
         raise HTTPException(status_code=501, detail="Módulo firebase_admin não está disponível. Instale-o com: pip install firebase-admin")
     
     try:
-        # Inicializar Firebase se necessário
-        try:
-            import firebase_admin
-            if not firebase_admin._apps:
-                success = initialize_firebase()
-                if not success:
-                    raise HTTPException(status_code=500, detail="Não foi possível inicializar o Firebase")
-        except (ImportError, NameError) as e:
-            raise HTTPException(status_code=500, detail=f"Erro ao acessar firebase_admin: {str(e)}")
+        # Firebase inicializado no startup da aplicação
+        if not firebase_pronto():
+            raise HTTPException(status_code=500, detail="Não foi possível inicializar o Firebase")
         
-        # Converter string JSON para dicionário
-        data = json.loads(report_data)
-        
-        # Extrair campos obrigatórios
-        user_id = data.get("user_id")
-        user_name = data.get("user_name")
-        planning_data = data.get("planning_data", {})
-        report_content = data.get("report_content")
+        # Decodificar e validar os campos obrigatórios do relatório
+        try:
+            dados = validar_report_data(report_data)
+        except ValidationError as e:
+            logger.warning(f"report_data inválido: {e.errors()}")
+            raise HTTPException(status_code=400, detail="Dados insuficientes ou inválidos para salvar o relatório")
         
-        if not user_id or not user_name or not report_content:
-            raise HTTPException(status_code=400, detail="Dados insuficientes para salvar o relatório")
+        user_id = dados.user_id
+        user_name = dados.user_name
+        planning_data = dados.planning_data or {}
+        report_content = dados.report_content
         
         # Checar se o plano foi registrado
         if stripe_available:
-            db = get_firestore_db()
-            user_doc = db.collection('usuarios').document(user_id).get()
+            # Leitura bloqueante do Firestore executada fora do loop de eventos
+            user_data = await get_user_data_async(user_id)
             
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
+            if user_data is not None:
                 subscription = user_data.get('subscription', {})
                 
                 if subscription:
@@ -832,7 +1476,7 @@ async def save_report_endpoint(
         document_type_map = {}
         if document_types:
             try:
-                doc_types = json.loads(document_types)
+                doc_types = json_helper.loads(document_types)
                 # Formato esperado: {"file_index": "document_type"}
                 if isinstance(doc_types, dict):
                     document_type_map = doc_types
@@ -861,25 +1505,8 @@ async def save_report_endpoint(
                     # Se tiver mapeamento de tipo de documento, usar ele
                     if str_index in document_type_map:
                         doc_type = document_type_map[str_index]
-                        # Mapeamento para categorias internas
-                        if doc_type == "imposto" or doc_type == "irpf":
-                            category = 'incomeTax'
-                        elif doc_type == "registro" or doc_type == "registrato" or doc_type == "scr" or doc_type == "contrato":
-                            category = 'registration'
-                        elif doc_type == "fiscal":
-                            category = 'taxStatus'
-                        elif doc_type == "faturamento_gerencial":
-                            category = 'managementBilling'
-                        elif doc_type == "faturamento" or doc_type == "faturamento_fiscal":
-                            category = 'taxBilling'
-                        elif doc_type == "spc" or doc_type == "serasa":
-                            category = 'spcSerasa'
-                        elif doc_type == "demonstrativo" or doc_type == "extrato":
-                            category = 'statement'
-                        elif doc_type == "cnpj":
-                            category = 'cnpj'
-                        else:
-                            category = doc_type
+                        # Mapeamento para categorias internas (tipos desconhecidos são usados como estão)
+                        category = CATEGORIAS_RELATORIO.get(doc_type, doc_type)
                     else:
                         # Se não houver tipo especificado, usar uma categoria genérica
                         category = f'document_{len(analysis_files)}'
@@ -894,8 +1521,8 @@ async def save_report_endpoint(
                 except Exception as e:
                     logger.error(f"Erro ao processar arquivo: {str(e)}")
         
-        # Salvar no Firebase
-        result = save_report(
+        # Salvar no Firebase sem bloquear o loop de eventos
+        result = await save_report_async(
             user_id=user_id,
             user_name=user_name,
             planning_data=planning_data,
@@ -915,8 +1542,8 @@ async def save_report_endpoint(
             "report_id": result.get("report_id")
         }
         
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Dados de relatório inválidos. Formato JSON esperado.")
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao salvar relatório: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao salvar relatório: {str(e)}")
@@ -931,9 +1558,8 @@ async def firebase_status():
         return {"available": False, "reason": "Módulo firebase_admin não está disponível. Instale-o com: pip install firebase-admin"}
     
     try:
-        # Verificar se o módulo firebase_admin está inicializado
-        import firebase_admin
-        is_initialized = initialize_firebase()
+        # Resultado da inicialização feita no startup da aplicação
+        is_initialized = firebase_pronto()
         
         return {
             "available": True,
@@ -947,13 +1573,27 @@ async def firebase_status():
         }
 
 # Inicializar Firebase e Stripe
-@app.on_event("startup")
+async def reenviar_pagamentos_pendentes():
+    """Regrava os pagamentos de /pagamentos/ cuja gravação não foi concluída"""
+    try:
+        regravados = await replay_pending_payments_async()
+        if regravados:
+            logger.info(f"{regravados} pagamentos pendentes regravados")
+    except Exception as e:
+        logger.error(f"Erro ao regravar pagamentos pendentes: {str(e)}")
+
 async def startup_event():
-    """Evento executado na inicialização da aplicação"""
-    # Inicializar Firebase
+    """Executado na inicialização da aplicação (ver lifespan)"""
+    # Inicializar Firebase uma única vez; os endpoints apenas consultam o resultado
+    app.state.firebase_initialized = False
     if firebase_available:
         try:
-            initialize_firebase()
+            app.state.firebase_initialized = initialize_firebase()
+            # Criar o cliente Firestore compartilhado (e a sua conexão) antes da primeira requisição
+            if app.state.firebase_initialized:
+                get_firestore_db()
+                # Regravar em segundo plano os pagamentos que ficaram pendentes
+                app.state.reenvio_pagamentos = asyncio.create_task(reenviar_pagamentos_pendentes())
         except Exception as e:
             logger.error(f"Erro ao inicializar Firebase no startup: {str(e)}")
 
@@ -963,6 +1603,26 @@ async def startup_event():
             init_stripe()
         except Exception as e:
             logger.error(f"Erro ao inicializar Stripe no startup: {str(e)}")
+    
+    # Criar o pool de processos da extração de texto
+    get_extraction_pool()
+    
+    # Ler o prompt uma única vez, antes da primeira requisição
+    get_system_prompt()
+    
+    app.state.health = montar_status_saude()
+
+async def shutdown_event():
+    """Executado no encerramento da aplicação (ver lifespan)"""
+    global _extraction_pool
+    
+    # Fechar as conexões HTTP mantidas pelo cliente OpenAI
+    if client is not None:
+        await client.close()
+    
+    if _extraction_pool is not None:
+        _extraction_pool.shutdown(wait=False)
+        _extraction_pool = None
 
 class DateRange(BaseModel):
     start_date: Optional[datetime.date] = None
@@ -973,11 +1633,15 @@ class DateRange(BaseModel):
 async def get_reports(
     start_date: Optional[str] = Query(None, description="Data inicial no formato YYYY-MM-DD"),
     end_date: Optional[str] = Query(None, description="Data final no formato YYYY-MM-DD"),
-    user_id: Optional[str] = Query(None, description="ID do usuário (opcional)")
+    user_id: Optional[str] = Query(None, description="ID do usuário (opcional)"),
+    fields: Optional[str] = Query(None, description="Campos a retornar, separados por vírgula (opcional)"),
+    page_size: Optional[int] = Query(None, ge=1, le=1000, description="Número máximo de relatórios por página (opcional)"),
+    start_after: Optional[str] = Query(None, description="ID do último relatório da página anterior (opcional)")
 ):
     """
     Retorna os relatórios disponíveis no intervalo de datas especificado.
     Se nenhuma data for especificada, retorna os relatórios do dia atual.
+    Com page_size, a resposta inclui next_cursor para buscar a página seguinte.
     """
     if not firebase_available:
         raise HTTPException(status_code=501, detail="Funcionalidade do Firebase não disponível")
@@ -985,14 +1649,9 @@ async def get_reports(
     if not firebase_admin_available:
         raise HTTPException(status_code=501, detail="Módulo firebase_admin não está disponível. Instale-o com: pip install firebase-admin")
     
-    # Inicializar Firebase se necessário
-    try:
-        import firebase_admin
-        if not firebase_admin._apps:
-            if not initialize_firebase():
-                raise HTTPException(status_code=500, detail="Falha ao inicializar Firebase")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erro ao acessar firebase_admin: {str(e)}")
+    # Firebase inicializado no startup da aplicação
+    if not firebase_pronto():
+        raise HTTPException(status_code=500, detail="Falha ao inicializar Firebase")
     
     # Converter strings de data para objetos date
     start_date_obj = None
@@ -1006,8 +1665,14 @@ async def get_reports(
     except ValueError:
         raise HTTPException(status_code=400, detail="Formato de data inválido. Use YYYY-MM-DD")
     
-    # Buscar relatórios
-    result = get_reports_by_date_range(user_id, start_date_obj, end_date_obj)
+    # Lista de campos projetados na consulta
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    
+    # Buscar relatórios (consulta bloqueante executada fora do loop de eventos)
+    result = await get_reports_by_date_range_async(
+        user_id, start_date_obj, end_date_obj,
+        fields=field_list, page_size=page_size, start_after=start_after
+    )
     
     if not result["success"]:
         # Se houve erro, retorna o erro como HTTP 500
@@ -1016,6 +1681,60 @@ async def get_reports(
     # Retornar os dados
     return result
 
+@app.get("/reports/stream/")
+async def stream_reports(
+    start_date: Optional[str] = Query(None, description="Data inicial no formato YYYY-MM-DD"),
+    end_date: Optional[str] = Query(None, description="Data final no formato YYYY-MM-DD"),
+    user_id: Optional[str] = Query(None, description="ID do usuário (opcional)"),
+    fields: Optional[str] = Query(None, description="Campos a retornar, separados por vírgula (opcional)")
+):
+    """
+    Retorna os relatórios do intervalo de datas em NDJSON (um relatório por linha),
+    enviando cada um assim que chega do Firestore. Indicado para intervalos grandes.
+    Erros ocorridos depois do início da resposta são enviados como última linha,
+    no formato {"error": "..."}.
+    """
+    if not firebase_available:
+        raise HTTPException(status_code=501, detail="Funcionalidade do Firebase não disponível")
+        
+    if not firebase_admin_available:
+        raise HTTPException(status_code=501, detail="Módulo firebase_admin não está disponível. Instale-o com: pip install firebase-admin")
+    
+    # Firebase inicializado no startup da aplicação
+    if not firebase_pronto():
+        raise HTTPException(status_code=500, detail="Falha ao inicializar Firebase")
+    
+    try:
+        start_date_obj = datetime.date.fromisoformat(start_date) if start_date else None
+        end_date_obj = datetime.date.fromisoformat(end_date) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de data inválido. Use YYYY-MM-DD")
+    
+    field_list = [field.strip() for field in fields.split(",") if field.strip()] if fields else None
+    
+    # Montar a consulta e buscar o primeiro relatório antes de enviar o status: erros de
+    # configuração ou da consulta (ex.: índice ausente) ainda viram uma resposta de erro
+    reports = iter_reports_by_date_range(user_id, start_date_obj, end_date_obj, fields=field_list)
+    try:
+        primeiro = await asyncio.get_running_loop().run_in_executor(None, next, reports, None)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Erro ao buscar relatórios: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Erro ao buscar relatórios: {str(e)}")
+    
+    def iter_ndjson():
+        if primeiro is None:
+            return
+        try:
+            for report in itertools.chain((primeiro,), reports):
+                yield json_helper.dumps_bytes(report, default=str) + b"\n"
+        except Exception as e:
+            logger.error(f"Erro durante o envio dos relatórios: {str(e)}")
+            yield json_helper.dumps_bytes({"error": str(e)}) + b"\n"
+    
+    return StreamingResponse(iter_ndjson(), media_type="application/x-ndjson")
+
 # Modelos para API Stripe
 class UserData(BaseModel):
     user_id: str
@@ -1057,7 +1776,7 @@ async def criar_cliente_endpoint(user_data: UserData):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    customer_id = criar_cliente(user_data.user_id, user_data.email, user_data.nome)
+    customer_id = await executar_em_thread(criar_cliente, user_data.user_id, user_data.email, user_data.nome)
     if not customer_id:
         raise HTTPException(status_code=500, detail="Erro ao criar cliente no Stripe")
 
@@ -1069,7 +1788,7 @@ async def checkout_pagamento(pagamento: PagamentoRequest):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = criar_sessao_checkout(pagamento.user_id, pagamento.plano_id)
+    resultado = await executar_em_thread(criar_sessao_checkout, pagamento.user_id, pagamento.plano_id)
     if not resultado.get("success"):
         raise HTTPException(status_code=500, detail=resultado.get("error", "Erro ao criar sessão de checkout"))
 
@@ -1081,7 +1800,7 @@ async def checkout_assinatura(pagamento: PagamentoRequest):
     if not stripe_available:
         raise HTTPException(status_code=503, detail="Serviço Stripe não está disponível")
     
-    resultado = criar_assinatura(pagamento.user_id, pagamento.plano_id)
+    resultado = await executar_em_thread(criar_assinatura, pagamento.user_id, pagamento.plano_id)
     
     if resultado.get("success"):
         return resultado
@@ -1095,7 +1814,12 @@ async def webhook(request: Request, stripe_signature: Optional[str] = Header(Non
         raise HTTPException(status_code=503, detail="Serviço Stripe não está disponível")
     
     payload = await request.body()
-    resultado = processar_webhook(payload, stripe_signature)
+    resultado = await executar_em_thread(processar_webhook, payload, stripe_signature)
+    
+    # Eventos que alteram o plano informam o usuário afetado
+    user_id = resultado.pop("user_id", None)
+    if user_id:
+        _plan_cache.pop(user_id)
     
     if resultado.get("success"):
         return resultado
@@ -1108,7 +1832,7 @@ async def listar_cartoes_endpoint(customer_id: str):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = listar_cartoes(customer_id)
+    resultado = await executar_em_thread(listar_cartoes, customer_id)
     if not resultado.get("success"):
         raise HTTPException(status_code=500, detail=resultado.get("error", "Erro ao listar cartões"))
 
@@ -1120,7 +1844,7 @@ async def adicionar_cartao_endpoint(cartao: CartaoRequest):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = adicionar_cartao(cartao.customer_id, cartao.payment_method_id, cartao.set_default)
+    resultado = await executar_em_thread(adicionar_cartao, cartao.customer_id, cartao.payment_method_id, cartao.set_default)
     if not resultado.get("success"):
         raise HTTPException(status_code=500, detail=resultado.get("error", "Erro ao adicionar cartão"))
 
@@ -1132,7 +1856,7 @@ async def remover_cartao_endpoint(customer_id: str, payment_method_id: str):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = remover_cartao(customer_id, payment_method_id)
+    resultado = await executar_em_thread(remover_cartao, customer_id, payment_method_id)
     if not resultado.get("success"):
         raise HTTPException(status_code=500, detail=resultado.get("error", "Erro ao remover cartão"))
 
@@ -1144,7 +1868,7 @@ async def atualizar_cartao_padrao_endpoint(customer_id: str, payment_method_id:
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = atualizar_cartao_padrao(customer_id, payment_method_id)
+    resultado = await executar_em_thread(atualizar_cartao_padrao, customer_id, payment_method_id)
     if not resultado.get("success"):
         raise HTTPException(status_code=500, detail=resultado.get("error", "Erro ao atualizar cartão padrão"))
 
@@ -1156,7 +1880,8 @@ async def consumir_relatorio_endpoint(user_id: str):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    resultado = consumir_relatorio(user_id)
+    resultado = await executar_em_thread(consumir_relatorio, user_id)
+    _plan_cache.pop(user_id)
     if not resultado.get("success"):
         raise HTTPException(status_code=400, detail=resultado.get("error", "Não há relatórios disponíveis"))
 
@@ -1170,31 +1895,57 @@ async def historico_pagamentos(user_id: str):
     if not stripe_available:
         raise HTTPException(status_code=503, detail="Serviço Stripe não está disponível")
     
-    resultado = obter_historico_pagamentos(user_id)
+    resultado = await executar_em_thread(obter_historico_pagamentos, user_id)
     
     if resultado.get("success"):
         return resultado
     else:
         raise HTTPException(status_code=400, detail=resultado.get("error", "Erro ao obter histórico de pagamentos"))
 
+# Tentativas de gravação de um pagamento em segundo plano, com espera exponencial entre elas
+PAGAMENTO_TENTATIVAS = int(os.getenv("PAGAMENTO_TENTATIVAS", "5"))
+PAGAMENTO_ESPERA_INICIAL = float(os.getenv("PAGAMENTO_ESPERA_INICIAL", "0.5"))
+
+async def persistir_pagamento(pagamento_id: str, user_id: str, payment_data: dict, payment_date):
+    """
+    Grava o pagamento registrado por /pagamentos/ depois que a resposta já foi enviada.
+    A gravação é idempotente (mesmo ID), então é repetida com espera exponencial; se todas
+    as tentativas falharem, o registro em 'pagamentos_pendentes' é regravado no próximo startup.
+    """
+    for tentativa in range(PAGAMENTO_TENTATIVAS):
+        try:
+            await save_payment_async(user_id, payment_data, payment_date, pagamento_id)
+            logger.info(f"Pagamento {pagamento_id} do usuário {user_id} gravado")
+            break
+        except Exception as e:
+            logger.warning(
+                f"Tentativa {tentativa + 1}/{PAGAMENTO_TENTATIVAS} de gravar o pagamento "
+                f"{pagamento_id} falhou: {str(e)}"
+            )
+            if tentativa + 1 < PAGAMENTO_TENTATIVAS:
+                await asyncio.sleep(PAGAMENTO_ESPERA_INICIAL * 2 ** tentativa)
+    else:
+        logger.error(f"Pagamento {pagamento_id} do usuário {user_id} mantido em pagamentos_pendentes")
+    
+    # Invalidar também após a gravação, para que uma consulta feita nesse intervalo não
+    # deixe o plano antigo em cache
+    _plan_cache.pop(user_id)
+
 @app.post("/pagamentos/")
-async def salvar_pagamento(pagamento_data: PagamentoData):
+async def salvar_pagamento(pagamento_data: PagamentoData, background_tasks: BackgroundTasks):
     """
-    Salva os dados de pagamento no Firestore
+    Salva os dados de pagamento no Firestore. O ID do pagamento é gerado localmente e
+    devolvido de imediato; a gravação é feita em segundo plano, após a resposta.
     """
     if not firebase_available:
         raise HTTPException(status_code=503, detail="Serviço Firebase não está disponível")
     
     try:
-        # Obter instância do Firestore
-        from firebase_admin import firestore
-        db = get_firestore_db()
-        
         # Preparar os dados do pagamento
         payment_data = {
             "subscription": {
                 "autoRenew": pagamento_data.auto_renew,
-                "endDate": pagamento_data.end_date,
+                "endDate": em_utc(pagamento_data.end_date),
                 "paymentInfo": {
                     "amount": pagamento_data.amount,
                     "lastPaymentDate": pagamento_data.start_date,
@@ -1215,26 +1966,103 @@ async def salvar_pagamento(pagamento_data: PagamentoData):
         payment_data["temPlano"] = True
         payment_data["userId"] = pagamento_data.user_id
         
-        # Salvar na coleção "pagamentos"
-        pagamento_ref = db.collection('pagamentos').document()
-        pagamento_ref.set(payment_data)
+        # Registrar a intenção no Firestore antes de responder: se a gravação em segundo
+        # plano falhar ou o processo cair antes do commit, o pagamento é regravado no startup
+        pagamento_id = new_payment_id()
+        await register_pending_payment_async(
+            pagamento_id, pagamento_data.user_id, payment_data, pagamento_data.start_date
+        )
+        logger.info(f"Pagamento {pagamento_id} do usuário {pagamento_data.user_id} agendado")
         
-        # Atualizar o documento do usuário com a referência ao pagamento
-        usuario_ref = db.collection('usuarios').document(pagamento_data.user_id)
-        usuario_ref.set({
-            'pagamentos': {
-                pagamento_ref.id: {
-                    'data': pagamento_data.start_date
-                }
-            }
-        }, merge=True)
+        # Pagamento e referência no usuário gravados em um único lote, após a resposta
+        background_tasks.add_task(
+            persistir_pagamento, pagamento_id, pagamento_data.user_id, payment_data, pagamento_data.start_date
+        )
+        _plan_cache.pop(pagamento_data.user_id)
         
-        return {"success": True, "pagamento_id": pagamento_ref.id}
+        return {"success": True, "pagamento_id": pagamento_id}
     
     except Exception as e:
         logger.error(f"Erro ao salvar pagamento: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao salvar pagamento: {str(e)}")
 
+# Campos do documento do usuário lidos por /stripe/plano/
+CAMPOS_PLANO_USUARIO = [
+    'temPlano',
+    'subscription.planName',
+    'subscription.reportsLeft',
+    'subscription.autoRenew',
+    'subscription.startDate',
+    'subscription.endDate',
+]
+
+# Respostas de /stripe/plano/ por usuário, já serializadas: o frontend consulta o plano a
+# cada navegação, mas ele só muda em compras, webhooks do Stripe, cancelamentos e consumo
+# de relatórios (que invalidam a entrada). A invalidação vale só para o processo que tratou
+# a alteração: com vários workers, os demais podem servir o plano antigo por até
+# PLAN_CACHE_TTL segundos, que é o limite real de consistência.
+_plan_cache = LRUCache(
+    maxsize=int(os.getenv("PLAN_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("PLAN_CACHE_TTL", "30"))
+)
+
+def em_utc(valor: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    """Datas recebidas sem fuso são consideradas UTC, como o Firestore faz ao gravá-las"""
+    if valor is not None and valor.tzinfo is None:
+        return valor.replace(tzinfo=datetime.timezone.utc)
+    return valor
+
+def data_iso(valor):
+    """Converte datas do Firestore para ISO 8601, como o jsonable_encoder do FastAPI faria"""
+    if isinstance(valor, datetime.date):
+        return valor.isoformat()
+    return valor
+
+def montar_resposta_plano(user_data: Optional[dict]) -> dict:
+    """
+    Resposta de /stripe/plano/ a partir dos campos da assinatura do usuário.
+    Contém apenas tipos nativos, para ser serializada diretamente em JSON.
+    """
+    # temPlano é mantido no documento do usuário pelas gravações de pagamento e pelo fim
+    # da assinatura no Stripe; documentos antigos, sem o campo, seguem pela assinatura
+    if user_data is None or user_data.get('temPlano') is False:
+        return {
+            "success": True,
+            "tem_plano": False,
+            "message": "Usuário não possui plano ativo"
+        }
+        
+    subscription = user_data.get('subscription', {})
+    
+    if not subscription:
+        return {
+            "success": True,
+            "tem_plano": False,
+            "message": "Usuário não possui plano ativo"
+        }
+    
+    # Verificar se a assinatura expirou. As datas de validade são gravadas em UTC e o
+    # Firestore as devolve com fuso, então a comparação é feita com o "agora" em UTC.
+    end_date = subscription.get('endDate')
+    if end_date and not subscription.get('autoRenew') and end_date < datetime.datetime.now(datetime.timezone.utc):
+        return {
+            "success": True,
+            "tem_plano": False,
+            "message": "Plano expirado"
+        }
+    
+    return {
+        "success": True,
+        "tem_plano": True,
+        "plano": {
+            "nome": subscription.get('planName', 'Desconhecido'),
+            "relatorios_restantes": subscription.get('reportsLeft', 0),
+            "renovacao_automatica": subscription.get('autoRenew', False),
+            "data_inicio": data_iso(subscription.get('startDate')),
+            "data_fim": data_iso(subscription.get('endDate'))
+        }
+    }
+
 # Endpoints adicionais para gestão de planos
 @app.get("/stripe/plano/{user_id}")
 async def obter_plano_usuario(user_id: str):
@@ -1242,53 +2070,22 @@ async def obter_plano_usuario(user_id: str):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
+    resposta = _plan_cache.get(user_id)
+    if resposta is not None:
+        return Response(content=resposta, media_type="application/json")
+
     try:
-        db = get_firestore_db()
-        user_doc = db.collection('usuarios').document(user_id).get()
-        
-        if not user_doc.exists:
-            return {
-                "success": True,
-                "tem_plano": False,
-                "message": "Usuário não possui plano ativo"
-            }
-            
-        user_data = user_doc.to_dict()
-        subscription = user_data.get('subscription', {})
-        
-        if not subscription:
-            return {
-                "success": True,
-                "tem_plano": False,
-                "message": "Usuário não possui plano ativo"
-            }
-        
-        # Verificar se a assinatura expirou
-        end_date = subscription.get('endDate')
-        if end_date and not subscription.get('autoRenew'):
-            if isinstance(end_date, datetime.datetime):
-                if end_date < datetime.datetime.now():
-                    return {
-                        "success": True,
-                        "tem_plano": False,
-                        "message": "Plano expirado"
-                    }
-        
-        return {
-            "success": True,
-            "tem_plano": True,
-            "plano": {
-                "nome": subscription.get('planName', 'Desconhecido'),
-                "relatorios_restantes": subscription.get('reportsLeft', 0),
-                "renovacao_automatica": subscription.get('autoRenew', False),
-                "data_inicio": subscription.get('startDate'),
-                "data_fim": subscription.get('endDate')
-            }
-        }
+        # Leitura bloqueante do Firestore executada fora do loop de eventos, projetada
+        # apenas nos campos da assinatura usados na resposta
+        user_data = await get_user_data_async(user_id, CAMPOS_PLANO_USUARIO)
+        resposta = json_helper.dumps_bytes(montar_resposta_plano(user_data))
         
     except Exception as e:
         logger.error(f"Erro ao obter plano do usuário: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao obter plano do usuário: {str(e)}")
+    
+    _plan_cache.set(user_id, resposta)
+    return Response(content=resposta, media_type="application/json")
 
 @app.post("/stripe/assinatura/cancelar/{user_id}")
 async def cancelar_assinatura(user_id: str):
@@ -1296,66 +2093,55 @@ async def cancelar_assinatura(user_id: str):
     if not stripe_available:
         raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
 
-    try:
-        # Buscar dados do usuário
-        db = get_firestore_db()
-        user_doc = db.collection('usuarios').document(user_id).get()
-        
-        if not user_doc.exists:
-            raise HTTPException(status_code=404, detail="Usuário não encontrado")
-            
-        user_data = user_doc.to_dict()
-        subscription = user_data.get('subscription', {})
-        subscription_id = subscription.get('stripeSubscriptionId')
-        
-        if not subscription_id:
-            raise HTTPException(status_code=400, detail="Usuário não possui assinatura ativa")
-            
-        # Cancelar assinatura no Stripe
-        stripe.Subscription.modify(
-            subscription_id,
-            cancel_at_period_end=True
-        )
-        
-        # Atualizar no Firestore
-        db.collection('usuarios').document(user_id).update({
-            'subscription.autoRenew': False,
-            'subscription.canceledAt': firestore.SERVER_TIMESTAMP
-        })
-        
-        return {
-            "success": True,
-            "message": "Assinatura cancelada com sucesso"
-        }
-        
-    except Exception as e:
-        logger.error(f"Erro ao cancelar assinatura: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Erro ao cancelar assinatura: {str(e)}")
-
-@app.get("/stripe/planos/")
-async def listar_planos():
-    """Lista os planos disponíveis"""
-    if not stripe_available:
-        raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
+    # Leitura e marcação do cancelamento em uma transação do Firestore, seguidas da
+    # chamada ao Stripe, fora do loop de eventos
+    resultado = await executar_em_thread(cancelar_assinatura_usuario, user_id)
+    _plan_cache.pop(user_id)
+    if not resultado.get("success"):
+        status_code = resultado.get("status_code", 500)
+        detail = resultado.get("error", "Erro desconhecido")
+        if status_code == 500:
+            detail = f"Erro ao cancelar assinatura: {detail}"
+        raise HTTPException(status_code=status_code, detail=detail)
     
+    return {
+        "success": True,
+        "message": resultado["message"]
+    }
+
+@functools.lru_cache(maxsize=1)
+def resposta_planos() -> bytes:
+    """
+    Resposta de /stripe/planos/ já serializada: PLANOS é fixo, então a lista formatada
+    e o JSON são montados uma única vez por processo.
+    """
     from app.stripe_service import PLANOS
     
     # Formatar os planos para o frontend
-    planos_formatados = []
-    for plano_id, plano in PLANOS.items():
-        planos_formatados.append({
+    planos_formatados = [
+        {
             "id": plano_id,
             "nome": plano["name"],
             "descricao": plano["description"],
             "preco": plano["price"] / 100,  # Converter de centavos para reais
             "relatorios": plano["reports"],
             "desconto": plano["discount"]
-        })
+        }
+        for plano_id, plano in PLANOS.items()
+    ]
     
-    return {
+    return json_helper.dumps_bytes({
         "success": True,
         "planos": planos_formatados
-    }
+    })
+
+@app.get("/stripe/planos/")
+async def listar_planos():
+    """Lista os planos disponíveis"""
+    if not stripe_available:
+        raise HTTPException(status_code=501, detail="Integração com Stripe não disponível")
+    
+    return Response(content=resposta_planos(), media_type="application/json")
 
 @app.post("/pagamento/pix/")
 async def pagamento_pix(pagamento: PixPagamentoRequest):
@@ -1363,11 +2149,13 @@ async def pagamento_pix(pagamento: PixPagamentoRequest):
     if not stripe_available or not firebase_available:
         raise HTTPException(status_code=503, detail="Serviços necessários não estão disponíveis")
     
-    resultado = criar_pagamento_pix(
+    resultado = await executar_em_thread(
+        criar_pagamento_pix,
         pagamento.user_id, 
         pagamento.plano_id, 
         pagamento.telefone
     )
+    _plan_cache.pop(pagamento.user_id)
     
     if resultado.get("success"):
         return resultado
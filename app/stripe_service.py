@@ -3,9 +3,15 @@ from dotenv import load_dotenv
 import stripe
 import logging
 import json
-from datetime import datetime
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
 from firebase_admin import firestore
-from .firebase_service import get_firestore_db
+from .firebase_service import get_firestore_db, run_transaction
+from . import json_helper
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -42,6 +48,32 @@ PLANOS = {
     }
 }
 
+# Executor das chamadas bloqueantes ao Stripe e ao Firestore feitas por este módulo,
+# para que os endpoints assíncronos não travem o loop de eventos a cada round-trip
+STRIPE_WORKERS = int(os.getenv("STRIPE_WORKERS", "8"))
+_stripe_executor = ThreadPoolExecutor(
+    max_workers=STRIPE_WORKERS,
+    thread_name_prefix="stripe"
+)
+
+# Sessão HTTP única para a API do Stripe: as chamadas de todas as threads do executor
+# reutilizam conexões keep-alive em vez de refazer o handshake TLS a cada requisição.
+# O pool acompanha o número de workers para que nenhuma thread descarte conexões.
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=STRIPE_WORKERS
+))
+stripe.default_http_client = stripe.http_client.RequestsClient(session=_stripe_session)
+
+async def executar_em_thread(func, *args, **kwargs):
+    """
+    Executa uma função síncrona deste módulo (ex.: criar_sessao_checkout) no executor
+    do Stripe e aguarda o resultado sem bloquear o loop de eventos.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_stripe_executor, functools.partial(func, *args, **kwargs))
+
 def init_stripe():
     """Verifica se a configuração do Stripe está correta"""
     try:
@@ -71,8 +103,9 @@ def criar_cliente(user_id, email, nome):
     """
     try:
         # Verificar se o cliente já existe
-        db = get_firestore_db()
-        user_doc = db.collection('usuarios').document(user_id).get()
+        # A mesma referência é usada na leitura e na gravação do ID do cliente
+        usuario_ref = get_firestore_db().collection('usuarios').document(user_id)
+        user_doc = usuario_ref.get(field_paths=['stripeCustomerId'])
         
         if user_doc.exists:
             user_data = user_doc.to_dict()
@@ -90,7 +123,7 @@ def criar_cliente(user_id, email, nome):
         )
         
         # Salvar ID do cliente no Firestore
-        db.collection('usuarios').document(user_id).set({
+        usuario_ref.set({
             'stripeCustomerId': customer.id
         }, merge=True)
         
@@ -244,6 +277,34 @@ def criar_assinatura(user_id, plano_id, customer_id=None):
         logger.error(f"Erro ao criar assinatura: {str(e)}")
         return {"success": False, "error": str(e)}
 
+def registrar_pagamento(db, user_id, subscription_usuario, payment_data, historico):
+    """
+    Grava um pagamento em um único lote do Firestore: os dados da assinatura e a referência
+    ao pagamento no documento do usuário, o documento em 'pagamentos' e o registro em
+    'pagamentos_historico'. Um round-trip em vez de quatro, e as gravações são aplicadas
+    juntas (o usuário nunca referencia um pagamento inexistente).
+    
+    Returns:
+        str: ID do documento criado em 'pagamentos'
+    """
+    usuario_ref = db.collection('usuarios').document(user_id)
+    pagamento_ref = db.collection('pagamentos').document()
+    
+    batch = db.batch()
+    batch.set(usuario_ref, {
+        'subscription': subscription_usuario,
+        'temPlano': True,
+        'pagamentos': {
+            pagamento_ref.id: {
+                'data': datetime.now()
+            }
+        }
+    }, merge=True)
+    batch.set(pagamento_ref, payment_data)
+    batch.set(db.collection('pagamentos_historico').document(), historico)
+    batch.commit()
+    return pagamento_ref.id
+
 def processar_webhook(payload, sig_header):
     """
     Processa webhooks enviados pelo Stripe
@@ -253,7 +314,7 @@ def processar_webhook(payload, sig_header):
         sig_header (str): Cabeçalho de assinatura
         
     Returns:
-        dict: Resultado do processamento
+        dict: Resultado do processamento (com user_id quando o plano do usuário foi alterado)
     """
     endpoint_secret = os.getenv('STRIPE_WEBHOOK_SECRET')
     
@@ -275,7 +336,7 @@ def processar_webhook(payload, sig_header):
         else:
             # Se não temos o segredo, confiamos no payload
             try:
-                event = json.loads(payload)
+                event = json_helper.loads(payload)
             except json.JSONDecodeError:
                 logger.error("Payload não é um JSON válido")
                 return {"success": False, "error": "Payload inválido"}
@@ -310,23 +371,21 @@ def processar_webhook(payload, sig_header):
                 reports_atuais = subscription_atual.get('reportsLeft', 0)
                 
                 # Estrutura antiga (mantida para compatibilidade)
-                db.collection('usuarios').document(user_id).set({
-                    'subscription': {
-                        'planName': PLANOS[plano_id]['name'],
-                        'creditosPlano': reports,  # Novo campo para armazenar os créditos fixos do plano
-                        'reportsLeft': reports_atuais + reports,  # Somar créditos novos com os restantes
-                        'startDate': firestore.SERVER_TIMESTAMP,
-                        'endDate': datetime.fromtimestamp(subscription.current_period_end),
-                        'autoRenew': True,
-                        'stripeSubscriptionId': subscription_id
-                    }
-                }, merge=True)
+                subscription_usuario = {
+                    'planName': PLANOS[plano_id]['name'],
+                    'creditosPlano': reports,  # Novo campo para armazenar os créditos fixos do plano
+                    'reportsLeft': reports_atuais + reports,  # Somar créditos novos com os restantes
+                    'startDate': firestore.SERVER_TIMESTAMP,
+                    'endDate': datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc),
+                    'autoRenew': True,
+                    'stripeSubscriptionId': subscription_id
+                }
                 
                 # Nova estrutura na coleção pagamentos
                 payment_data = {
                     "subscription": {
                         "autoRenew": True,
-                        "endDate": datetime.fromtimestamp(subscription.current_period_end),
+                        "endDate": datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc),
                         "paymentInfo": {
                             "amount": session['amount_total'] / 100.0,
                             "lastPaymentDate": datetime.now(),
@@ -343,21 +402,8 @@ def processar_webhook(payload, sig_header):
                     "userId": user_id
                 }
                 
-                # Salvar na coleção "pagamentos"
-                pagamento_ref = db.collection('pagamentos').document()
-                pagamento_ref.set(payment_data)
-                
-                # Atualizar o documento do usuário com a referência ao pagamento
-                db.collection('usuarios').document(user_id).set({
-                    'pagamentos': {
-                        pagamento_ref.id: {
-                            'data': datetime.now()
-                        }
-                    }
-                }, merge=True)
-                
-                # Registrar pagamento no histórico (mantido para compatibilidade)
-                db.collection('pagamentos_historico').add({
+                # Registro no histórico (mantido para compatibilidade)
+                historico = {
                     'usuarioId': user_id,
                     'planName': PLANOS[plano_id]['name'],
                     'amount': session['amount_total'],
@@ -366,7 +412,10 @@ def processar_webhook(payload, sig_header):
                     'status': 'completed',
                     'stripePaymentId': session['payment_intent'],
                     'tipo': 'assinatura'
-                })
+                }
+                
+                # Usuário, pagamento e histórico gravados em um único lote
+                registrar_pagamento(db, user_id, subscription_usuario, payment_data, historico)
                 
             else:
                 # Pagamento único
@@ -376,15 +425,13 @@ def processar_webhook(payload, sig_header):
                 reports_atuais = subscription_atual.get('reportsLeft', 0)
                 
                 # Estrutura antiga (mantida para compatibilidade)
-                db.collection('usuarios').document(user_id).set({
-                    'subscription': {
-                        'planName': PLANOS[plano_id]['name'],
-                        'creditosPlano': reports,  # Novo campo para armazenar os créditos fixos do plano
-                        'reportsLeft': reports_atuais + reports,  # Somar créditos novos com os restantes
-                        'startDate': firestore.SERVER_TIMESTAMP,
-                        'autoRenew': False
-                    }
-                }, merge=True)
+                subscription_usuario = {
+                    'planName': PLANOS[plano_id]['name'],
+                    'creditosPlano': reports,  # Novo campo para armazenar os créditos fixos do plano
+                    'reportsLeft': reports_atuais + reports,  # Somar créditos novos com os restantes
+                    'startDate': firestore.SERVER_TIMESTAMP,
+                    'autoRenew': False
+                }
                 
                 # Nova estrutura na coleção pagamentos
                 payment_data = {
@@ -406,21 +453,8 @@ def processar_webhook(payload, sig_header):
                     "userId": user_id
                 }
                 
-                # Salvar na coleção "pagamentos"
-                pagamento_ref = db.collection('pagamentos').document()
-                pagamento_ref.set(payment_data)
-                
-                # Atualizar o documento do usuário com a referência ao pagamento
-                db.collection('usuarios').document(user_id).set({
-                    'pagamentos': {
-                        pagamento_ref.id: {
-                            'data': datetime.now()
-                        }
-                    }
-                }, merge=True)
-                
-                # Registrar pagamento no histórico (mantido para compatibilidade)
-                db.collection('pagamentos_historico').add({
+                # Registro no histórico (mantido para compatibilidade)
+                historico = {
                     'usuarioId': user_id,
                     'planName': PLANOS[plano_id]['name'],
                     'amount': session['amount_total'],
@@ -429,10 +463,13 @@ def processar_webhook(payload, sig_header):
                     'status': 'completed',
                     'stripePaymentId': session['payment_intent'],
                     'tipo': 'pagamento_unico'
-                })
+                }
+                
+                # Usuário, pagamento e histórico gravados em um único lote
+                registrar_pagamento(db, user_id, subscription_usuario, payment_data, historico)
                 
             logger.info(f"Pagamento processado com sucesso para o usuário {user_id}")
-            return {"success": True}
+            return {"success": True, "user_id": user_id}
             
         elif event['type'] == 'invoice.payment_succeeded':
             # Renovação de assinatura
@@ -479,23 +516,21 @@ def processar_webhook(payload, sig_header):
             reports_do_plano = PLANOS[plano_id]['reports']
                 
             # Estrutura antiga (mantida para compatibilidade)
-            db.collection('usuarios').document(user_id).set({
-                'subscription': {
-                    'planName': PLANOS[plano_id]['name'],
-                    'creditosPlano': reports_do_plano,  # Novo campo para armazenar os créditos fixos do plano
-                    'reportsLeft': reports_atuais + reports_do_plano,  # Somar créditos novos com os restantes
-                    'startDate': firestore.SERVER_TIMESTAMP,
-                    'endDate': datetime.fromtimestamp(subscription.current_period_end),
-                    'autoRenew': True,
-                    'stripeSubscriptionId': subscription_id
-                }
-            }, merge=True)
+            subscription_usuario = {
+                'planName': PLANOS[plano_id]['name'],
+                'creditosPlano': reports_do_plano,  # Novo campo para armazenar os créditos fixos do plano
+                'reportsLeft': reports_atuais + reports_do_plano,  # Somar créditos novos com os restantes
+                'startDate': firestore.SERVER_TIMESTAMP,
+                'endDate': datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc),
+                'autoRenew': True,
+                'stripeSubscriptionId': subscription_id
+            }
             
             # Nova estrutura na coleção pagamentos
             payment_data = {
                 "subscription": {
                     "autoRenew": True,
-                    "endDate": datetime.fromtimestamp(subscription.current_period_end),
+                    "endDate": datetime.fromtimestamp(subscription.current_period_end, tz=timezone.utc),
                     "paymentInfo": {
                         "amount": invoice['amount_paid'] / 100.0,
                         "lastPaymentDate": datetime.now(),
@@ -512,21 +547,8 @@ def processar_webhook(payload, sig_header):
                 "userId": user_id
             }
             
-            # Salvar na coleção "pagamentos"
-            pagamento_ref = db.collection('pagamentos').document()
-            pagamento_ref.set(payment_data)
-            
-            # Atualizar o documento do usuário com a referência ao pagamento
-            db.collection('usuarios').document(user_id).set({
-                'pagamentos': {
-                    pagamento_ref.id: {
-                        'data': datetime.now()
-                    }
-                }
-            }, merge=True)
-            
-            # Registrar pagamento no histórico (mantido para compatibilidade)
-            db.collection('pagamentos_historico').add({
+            # Registro no histórico (mantido para compatibilidade)
+            historico = {
                 'usuarioId': user_id,
                 'planName': PLANOS[plano_id]['name'],
                 'amount': invoice['amount_paid'],
@@ -535,10 +557,13 @@ def processar_webhook(payload, sig_header):
                 'status': 'completed',
                 'stripePaymentId': invoice['payment_intent'],
                 'tipo': 'renovacao_assinatura'
-            })
+            }
+            
+            # Usuário, pagamento e histórico gravados em um único lote
+            registrar_pagamento(db, user_id, subscription_usuario, payment_data, historico)
             
             logger.info(f"Assinatura renovada com sucesso para o usuário {user_id}")
-            return {"success": True}
+            return {"success": True, "user_id": user_id}
             
         # Outros eventos que podemos processar:
         elif event['type'] == 'customer.subscription.deleted':
@@ -557,16 +582,18 @@ def processar_webhook(payload, sig_header):
             user_doc = usuarios[0]
             user_id = user_doc.id
             
-            # Atualizar assinatura do usuário como cancelada
+            # Atualizar assinatura do usuário como cancelada. O evento chega quando a
+            # assinatura termina de fato (fim do período), então o plano deixa de valer
             db.collection('usuarios').document(user_id).set({
                 'subscription': {
                     'autoRenew': False,
                     'canceledAt': firestore.SERVER_TIMESTAMP
-                }
+                },
+                'temPlano': False
             }, merge=True)
             
             logger.info(f"Assinatura cancelada para o usuário {user_id}")
-            return {"success": True}
+            return {"success": True, "user_id": user_id}
             
         logger.info(f"Evento do Stripe processado: {event['type']}")
         return {"success": True}
@@ -794,6 +821,112 @@ def atualizar_cartao_padrao(customer_id, payment_method_id):
         logger.error(f"Erro ao atualizar cartão padrão: {str(e)}")
         return {"success": False, "error": str(e)}
 
+# Tempo após o qual uma reserva de cancelamento sem conclusão (ex.: processo encerrado
+# durante a chamada ao Stripe) deixa de bloquear novas tentativas
+CANCELAMENTO_TIMEOUT = int(os.getenv("CANCELAMENTO_TIMEOUT", "60"))
+
+def _reservar_cancelamento(transaction, usuario_ref):
+    """
+    Lê a assinatura do usuário e reserva o cancelamento na mesma transação.
+    A reserva (cancelamentoPendente) só é trocada pelo cancelamento definitivo
+    (canceledSubscriptionId) depois que o Stripe confirma: requisições simultâneas
+    recebem 409 enquanto a primeira está em andamento, em vez de um sucesso que ainda
+    pode ser desfeito. A chave é o ID da assinatura, de modo que uma nova assinatura
+    (com outro ID) pode ser cancelada normalmente.
+    
+    Returns:
+        tuple: (ID da assinatura no Stripe ou None, erro ou None, status HTTP do erro)
+    """
+    snapshot = usuario_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None, "Usuário não encontrado", 404
+    
+    subscription = (snapshot.to_dict() or {}).get('subscription', {})
+    subscription_id = subscription.get('stripeSubscriptionId')
+    if not subscription_id:
+        return None, "Usuário não possui assinatura ativa", 400
+    
+    # Cancelamento desta assinatura já confirmado pelo Stripe
+    if subscription.get('canceledSubscriptionId') == subscription_id:
+        return None, None, None
+    
+    agora = datetime.now(timezone.utc)
+    pendente = subscription.get('cancelamentoPendente') or {}
+    if (pendente.get('subscriptionId') == subscription_id
+            and (agora - pendente['inicio']).total_seconds() < CANCELAMENTO_TIMEOUT):
+        return None, "Cancelamento da assinatura já está em andamento", 409
+    
+    transaction.update(usuario_ref, {
+        'subscription.cancelamentoPendente': {
+            'subscriptionId': subscription_id,
+            'inicio': agora
+        }
+    })
+    return subscription_id, None, None
+
+def cancelar_assinatura_usuario(user_id):
+    """
+    Cancela a assinatura do usuário ao fim do período atual.
+    
+    Args:
+        user_id (str): ID do usuário
+        
+    Returns:
+        dict: Resultado da operação (com status_code em caso de erro)
+    """
+    try:
+        usuario_ref = get_firestore_db().collection('usuarios').document(user_id)
+        subscription_id, erro, status_code = run_transaction(_reservar_cancelamento, usuario_ref)
+        if erro:
+            return {"success": False, "error": erro, "status_code": status_code}
+        
+        if subscription_id is None:
+            logger.info(f"Assinatura do usuário {user_id} já estava cancelada")
+            return {"success": True, "message": "Assinatura cancelada com sucesso"}
+        
+        try:
+            stripe.Subscription.modify(subscription_id, cancel_at_period_end=True)
+        except Exception:
+            # Liberar a reserva para que o cancelamento possa ser tentado novamente
+            usuario_ref.update({
+                'subscription.cancelamentoPendente': firestore.DELETE_FIELD
+            })
+            raise
+        
+        usuario_ref.update({
+            'subscription.autoRenew': False,
+            'subscription.canceledAt': firestore.SERVER_TIMESTAMP,
+            'subscription.canceledSubscriptionId': subscription_id,
+            'subscription.cancelamentoPendente': firestore.DELETE_FIELD
+        })
+        
+        logger.info(f"Assinatura {subscription_id} do usuário {user_id} cancelada")
+        return {"success": True, "message": "Assinatura cancelada com sucesso"}
+    except Exception as e:
+        logger.error(f"Erro ao cancelar assinatura: {str(e)}")
+        return {"success": False, "error": str(e), "status_code": 500}
+
+def _decrementar_relatorios(transaction, user_ref):
+    """
+    Consome um relatório do saldo do usuário, se houver saldo.
+    
+    Returns:
+        tuple: (relatórios restantes, erro ou None)
+    """
+    user_doc = user_ref.get(transaction=transaction)
+    if not user_doc.exists:
+        return None, "Usuário não encontrado"
+    
+    subscription = (user_doc.to_dict() or {}).get('subscription', {})
+    reports_left = subscription.get('reportsLeft', 0)
+    if reports_left <= 0:
+        return None, "Não há relatórios disponíveis"
+    
+    transaction.update(user_ref, {
+        'subscription.reportsLeft': reports_left - 1
+    })
+    return reports_left - 1, None
+
 def consumir_relatorio(user_id):
     """
     Reduz o contador de relatórios disponíveis para o usuário
@@ -805,28 +938,17 @@ def consumir_relatorio(user_id):
         dict: Resultado da operação ou erro
     """
     try:
-        db = get_firestore_db()
-        user_ref = db.collection('usuarios').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            return {"success": False, "error": "Usuário não encontrado"}
-            
-        user_data = user_doc.to_dict()
-        subscription = user_data.get('subscription', {})
-        reports_left = subscription.get('reportsLeft', 0)
+        user_ref = get_firestore_db().collection('usuarios').document(user_id)
         
-        if reports_left <= 0:
-            return {"success": False, "error": "Não há relatórios disponíveis"}
-        
-        # Atualizar contador de relatórios
-        user_ref.update({
-            'subscription.reportsLeft': reports_left - 1
-        })
+        # Leitura e decremento na mesma transação: análises simultâneas do mesmo usuário
+        # não podem ler o mesmo saldo e consumir um único relatório
+        reports_left, erro = run_transaction(_decrementar_relatorios, user_ref)
+        if erro:
+            return {"success": False, "error": erro}
         
         return {
             "success": True, 
-            "reports_left": reports_left - 1
+            "reports_left": reports_left
         }
         
     except Exception as e:
@@ -888,6 +1010,9 @@ def criar_pagamento_pix(user_id, plano_id, telefone=None):
         # Gerar ID de pagamento mockado (em produção seria o ID do Stripe ou outra plataforma de pagamento)
         payment_id = f"mock_payment_{int(datetime.now().timestamp() * 1000)}"
         
+        # Datas de validade sempre em UTC, como o Firestore as devolve na leitura
+        agora = datetime.now(timezone.utc)
+        
         # Obter instância do Firestore
         db = get_firestore_db()
         
@@ -895,7 +1020,7 @@ def criar_pagamento_pix(user_id, plano_id, telefone=None):
         payment_data = {
             "subscription": {
                 "autoRenew": True,
-                "endDate": datetime.now().replace(year=datetime.now().year + 1),  # 1 ano de validade
+                "endDate": agora.replace(year=agora.year + 1),  # 1 ano de validade
                 "paymentInfo": {
                     "amount": plano['price'] / 100.0,  # Converter de centavos para reais
                     "lastPaymentDate": datetime.now(),
@@ -914,39 +1039,26 @@ def criar_pagamento_pix(user_id, plano_id, telefone=None):
         if telefone:
             payment_data["telefone"] = telefone
         
-        # Salvar na coleção "pagamentos"
-        pagamento_ref = db.collection('pagamentos').document()
-        pagamento_ref.set(payment_data)
-        
         # Verificar créditos atuais do usuário, se houver
         user_data = db.collection('usuarios').document(user_id).get().to_dict() or {}
         subscription_atual = user_data.get('subscription', {})
         reports_atuais = subscription_atual.get('reportsLeft', 0)
         
-        # Atualizar o documento do usuário
-        db.collection('usuarios').document(user_id).set({
-            'subscription': {
-                'planName': plano['name'],
-                'creditosPlano': plano['reports'],  # Novo campo para armazenar os créditos fixos do plano
-                'reportsLeft': reports_atuais + plano['reports'],  # Somar créditos novos com os restantes
-                'startDate': firestore.SERVER_TIMESTAMP,
-                'endDate': payment_data["subscription"]["endDate"],
-                'autoRenew': True
-            },
-            'pagamentos': {
-                pagamento_ref.id: {
-                    'data': datetime.now()
-                }
-            }
-        }, merge=True)
-        
-        # Atualizar também na coleção pagamentos
         payment_data["subscription"]["creditosPlano"] = plano['reports']
         payment_data["subscription"]["reportsLeft"] = reports_atuais + plano['reports']
-        pagamento_ref.set(payment_data)
         
-        # Registrar pagamento no histórico (mantido para compatibilidade)
-        db.collection('pagamentos_historico').add({
+        # Dados da assinatura no documento do usuário
+        subscription_usuario = {
+            'planName': plano['name'],
+            'creditosPlano': plano['reports'],  # Novo campo para armazenar os créditos fixos do plano
+            'reportsLeft': reports_atuais + plano['reports'],  # Somar créditos novos com os restantes
+            'startDate': firestore.SERVER_TIMESTAMP,
+            'endDate': payment_data["subscription"]["endDate"],
+            'autoRenew': True
+        }
+        
+        # Registro no histórico (mantido para compatibilidade)
+        historico = {
             'usuarioId': user_id,
             'planName': plano['name'],
             'amount': plano['price'],
@@ -955,12 +1067,15 @@ def criar_pagamento_pix(user_id, plano_id, telefone=None):
             'status': 'completed',
             'stripePaymentId': payment_id,
             'tipo': 'pagamento_pix'
-        })
+        }
+        
+        # Usuário, pagamento e histórico gravados em um único lote
+        pagamento_id = registrar_pagamento(db, user_id, subscription_usuario, payment_data, historico)
         
         return {
             "success": True,
             "payment_id": payment_id,
-            "pagamento_ref": pagamento_ref.id,
+            "pagamento_ref": pagamento_id,
             "plano": plano['name'],
             "valor": plano['price'] / 100.0,
             "reports": plano['reports']
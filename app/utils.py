@@ -14,54 +14,60 @@ from typing import Dict, Any, Tuple
 
 logger = logging.getLogger(__name__)
 
-async def extract_text_from_document(file: UploadFile) -> str:
-    """Extrai texto de diferentes tipos de arquivo"""
-    content_type = file.content_type
+# Tipos de conteúdo aceitos para extração de texto
+IMAGE_CONTENT_TYPES = frozenset({"image/jpeg", "image/png"})
+WORD_CONTENT_TYPES = frozenset({"application/msword",
+                                "application/vnd.openxmlformats-officedocument.wordprocessingml.document"})
+SUPPORTED_CONTENT_TYPES = frozenset({"application/pdf"}) | IMAGE_CONTENT_TYPES | WORD_CONTENT_TYPES
+
+def init_extraction_worker():
+    """
+    Inicializador dos processos do pool de extração. Importar este módulo já carrega
+    PyMuPDF, Tesseract, Pillow e python-docx uma vez por processo (inclusive com o método
+    spawn); aqui também são registrados os plugins do Pillow, que de outra forma seriam
+    carregados na primeira imagem de cada processo.
+    """
+    Image.init()
+
+def extract_text_from_bytes(file_content: bytes, content_type: str, filename: str = "") -> str:
+    """
+    Extrai texto dos bytes de um arquivo conforme o seu tipo de conteúdo.
+    Função síncrona e de nível de módulo, para poder ser executada em um pool de processos.
+    """
     logger.info(f"Extraindo texto de arquivo tipo: {content_type}")
     
-    # Ler o conteúdo do arquivo uma vez
-    file_content = await file.read()
-    
-    # Para arquivos PDF
-    if content_type == "application/pdf":
-        text = extract_text_from_pdf_bytes(file_content)
-        print(f"\n----- CONTEÚDO EXTRAÍDO DO PDF: {file.filename} -----")
-        print(f"{text[:500]}...")  # Mostra apenas os primeiros 500 caracteres
-        print(f"----- FIM DO CONTEÚDO EXTRAÍDO ({len(text)} caracteres) -----\n")
-        return text
-    
-    # Para imagens JPEG/PNG
-    elif content_type in ["image/jpeg", "image/png"]:
-        text = extract_text_from_image_bytes(file_content)
-        print(f"\n----- CONTEÚDO EXTRAÍDO DA IMAGEM: {file.filename} -----")
-        print(f"{text[:500]}...")  # Mostra apenas os primeiros 500 caracteres
-        print(f"----- FIM DO CONTEÚDO EXTRAÍDO ({len(text)} caracteres) -----\n")
-        return text
-    
-    # Para documentos Word
-    elif content_type in ["application/msword", 
-                        "application/vnd.openxmlformats-officedocument.wordprocessingml.document"]:
-        text = extract_text_from_word_bytes(file_content)
-        print(f"\n----- CONTEÚDO EXTRAÍDO DO WORD: {file.filename} -----")
-        print(f"{text[:500]}...")  # Mostra apenas os primeiros 500 caracteres
-        print(f"----- FIM DO CONTEÚDO EXTRAÍDO ({len(text)} caracteres) -----\n")
-        return text
-    
-    # Tipo não suportado
-    else:
+    extrator = EXTRACTORS.get(content_type)
+    if extrator is None:
         logger.warning(f"Tipo de arquivo não suportado: {content_type}")
         return ""
+    
+    extract, origem = extrator
+    text = extract(file_content)
+    
+    print(f"\n----- CONTEÚDO EXTRAÍDO {origem}: {filename} -----")
+    print(f"{text[:500]}...")  # Mostra apenas os primeiros 500 caracteres
+    print(f"----- FIM DO CONTEÚDO EXTRAÍDO ({len(text)} caracteres) -----\n")
+    return text
+
+async def extract_text_from_document(file: UploadFile) -> str:
+    """Extrai texto de diferentes tipos de arquivo"""
+    # Ler o conteúdo do arquivo uma vez
+    file_content = await file.read()
+    return extract_text_from_bytes(file_content, file.content_type, file.filename)
 
 def extract_text_from_pdf_bytes(file_content: bytes) -> str:
     """Extrai texto de PDF a partir de bytes"""
     try:
-        content = ''
+        # Os trechos de cada página são acumulados em lista e unidos uma única vez,
+        # evitando recopiar o texto inteiro a cada página em PDFs longos
+        trechos = []
         with fitz.open(stream=file_content, filetype="pdf") as doc:
             for page_num, page in enumerate(doc):
                 page_text = page.get_text()
                 if page_text.strip():  # Só adiciona se a página tem conteúdo
-                    content += f"\n--- Página {page_num + 1} ---\n"
-                    content += page_text
+                    trechos.append(f"\n--- Página {page_num + 1} ---\n")
+                    trechos.append(page_text)
+        content = "".join(trechos)
         logger.info(f"PDF processado: {len(content)} caracteres extraídos")
         return content
     except Exception as e:
@@ -83,13 +89,8 @@ def extract_text_from_image_bytes(file_content: bytes) -> str:
 def extract_text_from_word_bytes(file_content: bytes) -> str:
     """Extrai texto de um documento Word"""
     try:
-        # Salva o arquivo temporariamente
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as temp_file:
-            temp_file.write(file_content)
-            temp_path = temp_file.name
-        
-        # Processa o documento Word
-        doc = docx.Document(temp_path)
+        # Processa o documento Word diretamente da memória, sem arquivo temporário
+        doc = docx.Document(io.BytesIO(file_content))
         paragraphs = []
         
         for paragraph in doc.paragraphs:
@@ -98,9 +99,6 @@ def extract_text_from_word_bytes(file_content: bytes) -> str:
         
         content = '\n'.join(paragraphs)
         
-        # Remove o arquivo temporário
-        os.unlink(temp_path)
-        
         logger.info(f"Documento Word processado: {len(content)} caracteres extraídos")
         return content
         
@@ -108,6 +106,44 @@ def extract_text_from_word_bytes(file_content: bytes) -> str:
         logger.error(f"Erro ao processar documento Word: {str(e)}")
         raise Exception(f"Erro ao processar documento Word: {str(e)}")
 
+# Extrator de cada tipo de conteúdo suportado: (função, origem exibida no log)
+EXTRACTORS = {
+    "application/pdf": (extract_text_from_pdf_bytes, "DO PDF"),
+    **{content_type: (extract_text_from_image_bytes, "DA IMAGEM") for content_type in IMAGE_CONTENT_TYPES},
+    **{content_type: (extract_text_from_word_bytes, "DO WORD") for content_type in WORD_CONTENT_TYPES},
+}
+
+# Assinaturas (magic bytes) do início de cada tipo de arquivo suportado. O .docx é um pacote ZIP
+# e o .doc um arquivo OLE2; o cabeçalho do PDF pode vir depois de alguns bytes de lixo.
+ASSINATURAS = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"PK\x03\x04", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/msword"),
+)
+
+# Bytes iniciais lidos para identificar o tipo do arquivo
+TAMANHO_CABECALHO = 1024
+
+def detectar_tipo_conteudo(cabecalho: bytes):
+    """
+    Identifica o tipo do arquivo pelos bytes iniciais, sem depender do content_type
+    informado pelo cliente.
+    
+    Returns:
+        str | None: Tipo de conteúdo detectado, ou None se não for um formato suportado
+    """
+    for assinatura, content_type in ASSINATURAS:
+        if cabecalho.startswith(assinatura):
+            return content_type
+    if b"%PDF-" in cabecalho[:TAMANHO_CABECALHO]:
+        return "application/pdf"
+    return None
+
+def mesmo_extrator(content_type_a: str, content_type_b: str) -> bool:
+    """Verifica se dois tipos de conteúdo suportados são extraídos pela mesma função"""
+    return EXTRACTORS[content_type_a][0] is EXTRACTORS[content_type_b][0]
+
 # Funções antigas para compatibilidade (deprecated)
 def extract_text_from_pdf(file: UploadFile) -> str:
     """Função deprecated - use extract_text_from_pdf_bytes"""
@@ -323,7 +359,6 @@ def pdf_para_dataframe(pdf_bytes):
             print("⚠️ Nenhuma tabela encontrada no PDF")
             
         # Limpar arquivo temporário
-        import os
         os.unlink(temp_path)
         
         return df_final